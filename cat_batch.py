@@ -0,0 +1,136 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import earthquakeFinder as eqf
+from cat_metrics import metrics
+
+'''
+Batch mode of earthquakeFinder.py (batch=<file>): many queries in one process.
+Every line of the file is a query in the command line syntax (empty lines and lines starting
+with # are skipped), e.g.
+    clat=22,clon=121,mxrad=2,mnmag=3,outfile=taiwan.txt
+    mnla=30,mxla=46,mnlo=128,mxlo=146,mnmag=4,outfile=japan.txt
+Lines without outfile are written to catalog_<line number>.<fmt>, malformed lines (unknown
+parameters, values which do not parse) are reported and skipped.
+
+Event queries with the same providers which overlap in time are coalesced into one upstream
+request for their bounding box, time, depth and magnitude ranges, as long as that request is
+expected to return at most COALESCE_RATIO times the events of the separate queries (see
+volume), the events of each query are then selected locally (cat_index).
+The providers (and their FDSN clients) are shared by all requests, `nworkers` requests run
+at the same time. Focal mechanism queries (fm=yes) are run one by one and fall back to the
+events of the providers when ISC fails, like the command line.
+'''
+
+COALESCE_RATIO = 4.   # largest upstream request (relative to the summed volumes of its queries)
+GR_B = 1.             # Gutenberg-Richter b value: one magnitude unit lower, about 10 times more events
+
+
+def readBatch(path):
+    queries = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                query = eqf.parseArgs(line, strict=True)
+            except ValueError as e:
+                # a malformed line would otherwise run the default (global) query
+                print("Skipping line {} of {}: {}".format(n, path, e))
+                continue
+            if "outfile=" not in line:
+                query.outfile = "catalog_{}.{}".format(n, query.fmt)
+            queries.append(query)
+    return queries
+
+def area(box):
+    return (box[1] - box[0]) * (box[3] - box[2])
+
+def volume(start, end, box, minM, minD, maxD):
+    # relative number of events of a request: days x area x depth range, scaled by the magnitude threshold
+    return max((end - start).total_seconds() / 86400., 1.) * area(box) * max(maxD - minD, 1.) * 10 ** (-GR_B * minM)
+
+def coalesce(queries, ratio=COALESCE_RATIO):
+    # groups of queries which are fetched with one upstream request
+    groups = []
+    for query in sorted(queries, key=lambda q: q.starttime):
+        box = query.bounds()
+        key = (tuple(query.providers), query.federate, query.cache, query.nworkers)
+        own = volume(query.starttime, query.endtime, box, query.minM, query.minD, query.maxD)
+        for group in groups:
+            if group["key"] != key or query.starttime > group["end"] or query.endtime < group["start"]:
+                continue
+            union = dict(box=(min(group["box"][0], box[0]), max(group["box"][1], box[1]), min(group["box"][2], box[2]), max(group["box"][3], box[3])),
+                         start=min(group["start"], query.starttime), end=max(group["end"], query.endtime),
+                         minM=min(group["minM"], query.minM), maxM=max(group["maxM"], query.maxM),
+                         minD=min(group["minD"], query.minD), maxD=max(group["maxD"], query.maxD))
+            if volume(union["start"], union["end"], union["box"], union["minM"], union["minD"], union["maxD"]) <= ratio * (group["volume"] + own):
+                group.update(union)
+                group["queries"].append(query)
+                group["volume"] += own
+                break
+        else:
+            groups.append(dict(key=key, queries=[query], box=box, start=query.starttime, end=query.endtime, volume=own,
+                               minM=query.minM, maxM=query.maxM, minD=query.minD, maxD=query.maxD))
+    return groups
+
+def upstream(group):
+    # one query covering all the queries of the group
+    queries = group["queries"]
+    if len(queries) == 1:
+        return queries[0]
+    first = queries[0]
+    minlat, maxlat, minlon, maxlon = group["box"]
+    return eqf.EventQuery(starttime=group["start"], endtime=group["end"], minlat=minlat, maxlat=maxlat, minlon=minlon, maxlon=maxlon,
+                          minD=group["minD"], maxD=group["maxD"], minM=group["minM"], maxM=group["maxM"],
+                          nworkers=first.nworkers, cache=first.cache, ttl=first.ttl, providers=first.providers, federate=first.federate)
+
+
+class Batch(object):
+    def __init__(self, queries):
+        self.queries = queries
+        self.lock = threading.Lock()
+        self.providers = {}   # (providers, nworkers) -> shared provider objects
+
+    def sources(self, query):
+        key = (tuple(query.providers), query.nworkers)
+        with self.lock:
+            if key not in self.providers:
+                self.providers[key] = eqf.makeProviders(query.providers, nworkers=query.nworkers)
+            return self.providers[key]
+
+    def runGroup(self, group):
+        queries = group["queries"]
+        try:
+            cols = eqf.queryEvents(upstream(group), sources=self.sources(queries[0]))
+            if len(queries) == 1:
+                eqf.saveEvents(queries[0].outfile, cols, fmt=queries[0].fmt)
+            else:
+                import cat_index
+                with metrics.stage("split"):
+                    index = cat_index.CatalogIndex(eqf.eventTable(cols))
+                    tables = [index.query(q) for q in queries]
+                for q, table in zip(queries, tables):
+                    eqf.saveTable(q.outfile, table, fmt=q.fmt)
+            print("{}: {} events fetched for {}".format(group["start"].strftime("%Y/%m/%d"), len(cols["id"]), ", ".join(q.outfile for q in queries)))
+        except Exception as e:
+            print("Failed to fetch the data of {} in the {} stage: {}".format(", ".join(q.outfile for q in queries), getattr(e, "stage", "fetch"), e))
+
+    def runFocal(self, query):
+        try:
+            eqf.saveTable(query.outfile, eqf.find_events(query, fallback=True), fmt=query.fmt)
+        except Exception as e:
+            print("Failed to fetch the data of {} in the {} stage: {}".format(query.outfile, getattr(e, "stage", "fetch"), e))
+
+    def run(self, nworkers=1):
+        groups = coalesce([q for q in self.queries if not q.fm])
+        focal = [q for q in self.queries if q.fm]
+        print("{} queries, {} upstream requests".format(len(self.queries), len(groups) + len(focal)))
+        with ThreadPoolExecutor(max_workers=max(nworkers, 1)) as pool:
+            jobs = [pool.submit(self.runGroup, group) for group in groups] + [pool.submit(self.runFocal, q) for q in focal]
+            for job in jobs:
+                job.result()
+
+
+def runBatch(queries, nworkers=1):
+    Batch(queries).run(nworkers=nworkers)
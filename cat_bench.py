@@ -0,0 +1,306 @@
+import os
+import io
+import gc
+import sys
+import json
+import time
+import datetime
+import platform
+import threading
+import tracemalloc
+import numpy as np
+import earthquakeFinder as eqf
+
+'''
+Offline benchmark of the earthquakeFinder.py stages.
+QuakeML and ISC FMCSV responses are replayed from a local HTTP stub, every stage is timed
+(best of `repeat` runs) and its peak Python/NumPy memory is measured (tracemalloc, one
+extra run). The results are written as JSON, a previous result file can be compared.
+
+# Examples:
+## default sizes (1k and 100k events), results in bench.json
+python3 cat_bench.py
+
+## 1M events, three timed runs per stage, compared with an older run (exit status 1 on regression)
+python3 cat_bench.py sizes=1000000,repeat=3,out=new.json,compare=old.json
+
+## only some stages
+python3 cat_bench.py stages=quakeml_parse/fdsn_fetch/write_txt
+
+Parameters (default values in the braces):
+sizes(1000/100000),repeat(1),stages(all),fixtures(bench_fixtures),out(bench.json),compare(none),tolerance(1.2)
+
+Fixtures: events_<size>.xml (QuakeML) and fm_<size>.csv (ISC FMCSV page) in the fixtures
+directory. Missing fixtures are synthesized, recorded responses can be put there instead.
+'''
+
+STAGES = ["quakeml_parse", "fdsn_fetch", "fmcsv_parse", "isc_fetch", "write_txt", "write_npz", "write_fm_txt",
+          "cinput", "local_query", "qplot"]
+START = datetime.datetime(2015, 1, 1)
+DAYS = 150          # origin times of the fixtures (one ISC time tile)
+TOLERANCE = 1.2     # slower by more than this factor is a regression
+
+QUAKEML_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n<q:quakeml xmlns:q="http://quakeml.org/xmlns/quakeml/1.2" '
+                'xmlns="http://quakeml.org/xmlns/bed/1.2"><eventParameters publicID="smi:bench/catalog">\n')
+QUAKEML_EVENT = ('<event publicID="smi:bench/event/%d"><preferredOriginID>smi:bench/origin/%d</preferredOriginID>'
+                 '<preferredMagnitudeID>smi:bench/magnitude/%d</preferredMagnitudeID><description><text>%s</text>'
+                 '<type>Flinn-Engdahl region</type></description><origin publicID="smi:bench/origin/%d">'
+                 '<time><value>%sZ</value></time><latitude><value>%.4f</value></latitude><longitude><value>%.4f</value></longitude>'
+                 '<depth><value>%.1f</value></depth></origin><magnitude publicID="smi:bench/magnitude/%d"><mag><value>%.1f</value></mag>'
+                 '<type>%s</type></magnitude></event>\n')
+QUAKEML_TAIL = '</eventParameters></q:quakeml>\n'
+FMCSV_HEAD = ["<!DOCTYPE html>", "<html>", "<head>", "<title>ISC Bulletin</title>", "</head>", "<body>"] + ["<p></p>"] * 18 + [
+    "<pre>", "FOCAL MECHANISMS",
+    "EVENT_ID,AUTHOR   ,DATE      ,TIME       ,LAT     ,LON      ,DEPTH ,CENTROID,AUTHOR   ,EX,MO    ,MW  ,EX,MRR   ,MTT   ,MPP   ,MRT   ,"
+    "MTP   ,MPR   ,STRIKE,DIP  ,RAKE   ,STRIKE,DIP  ,RAKE   ,EX,T_VAL ,T_PL,T_AZM,P_VAL ,P_PL,P_AZM,N_VAL ,N_PL,N_AZM"]
+FMCSV_ROW = (" %9d,ISC      ,%s,%s, %.3f, %.3f, %.1f,  TRUE  ,GCMT     ,18,%.3f,%.1f,18,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,"
+             "%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,  ,      ,    ,     ,      ,    ,     ,      ,    ,     ")
+FMCSV_TAIL = ["</pre>", "<hr>", "<p>STOP</p>", "</body>", "</html>", ""]
+
+
+###########################################################################################
+def randomEvents(size, seed=0):
+    # random event columns with origin times in START..START+DAYS, latest first
+    rng = np.random.default_rng(seed)
+    t = np.datetime64(START, "us") + np.sort(rng.integers(0, DAYS * 86400 * 10**6, size))[::-1].astype("timedelta64[us]")
+    return dict(time=t, lon=rng.uniform(-180, 180, size), lat=np.degrees(np.arcsin(rng.uniform(-1, 1, size))),
+                depth=rng.uniform(0, 700e3, size), mag=np.round(rng.uniform(4, 9, size), 1),
+                magtype=rng.choice(["mb", "Mw", "MS", "ML"], size), name=rng.choice(["TAIWAN", "NEAR COAST OF PERU", "FIJI ISLANDS REGION"], size))
+
+def writeQuakeML(path, size):
+    ev = randomEvents(size)
+    times = np.datetime_as_string(ev["time"], unit="us")
+    with open(path, "w") as f:
+        f.write(QUAKEML_HEAD)
+        rows = zip(range(size), ev["name"].tolist(), times.tolist(), ev["lat"].tolist(), ev["lon"].tolist(),
+                   ev["depth"].tolist(), ev["mag"].tolist(), ev["magtype"].tolist())
+        f.writelines(QUAKEML_EVENT % (i, i, i, name, i, t, lat, lon, dep, i, mag, mt) for i, name, t, lat, lon, dep, mag, mt in rows)
+        f.write(QUAKEML_TAIL)
+
+def writeFMCSV(path, size):
+    ev = randomEvents(size, seed=1)
+    rng = np.random.default_rng(2)
+    days = np.datetime_as_string(ev["time"], unit="D")
+    clock = [t[11:] for t in np.datetime_as_string(ev["time"], unit="ms").tolist()]
+    tensor = rng.uniform(-3, 3, (size, 6))
+    planes = np.column_stack([rng.uniform(0, 360, size), rng.uniform(0, 90, size), rng.uniform(-180, 180, size),
+                              rng.uniform(0, 360, size), rng.uniform(0, 90, size), rng.uniform(-180, 180, size)])
+    rows = zip(range(size), days.tolist(), clock, ev["lat"].tolist(), ev["lon"].tolist(), (ev["depth"] / 1000).tolist(),
+               rng.uniform(1, 9, size).tolist(), ev["mag"].tolist(), tensor.tolist(), planes.tolist())
+    with open(path, "w") as f:
+        f.write("\n".join(FMCSV_HEAD) + "\n")
+        f.writelines(FMCSV_ROW % ((600000000 + i, d, c, lat, lon, dep, m0, mw) + tuple(mt) + tuple(pl)) + "\n"
+                     for i, d, c, lat, lon, dep, m0, mw, mt, pl in rows)
+        f.write("\n".join(FMCSV_TAIL))
+
+def fixtures(directory, size):
+    # (QuakeML path, FMCSV path) of the size, synthesized when missing
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    xml = os.path.join(directory, "events_{}.xml".format(size))
+    csv = os.path.join(directory, "fm_{}.csv".format(size))
+    if not os.path.exists(xml):
+        print("Writing {}".format(xml))
+        writeQuakeML(xml, size)
+    if not os.path.exists(csv):
+        print("Writing {}".format(csv))
+        writeFMCSV(csv, size)
+    return xml, csv
+
+
+###########################################################################################
+#Local HTTP stub of the FDSN event service and the ISC focal mechanism search
+class Stub(object):
+    def __init__(self):
+        from http.server import ThreadingHTTPServer
+        self.quakeml = b""
+        self.fmcsv = ""
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def load(self, xml, csv):
+        with open(xml, "rb") as f:
+            self.quakeml = f.read()
+        with open(csv) as f:
+            self.fmcsv = f.read()
+        # rows of the FMCSV page and their longitudes, for the longitude tiles of the ISC requests
+        lines = self.fmcsv.splitlines(True)
+        self.fmhead, self.fmrows, self.fmtail = lines[:len(FMCSV_HEAD)], np.array(lines[len(FMCSV_HEAD):-len(FMCSV_TAIL) + 1], dtype=object), lines[-len(FMCSV_TAIL) + 1:]
+        self.fmlon = np.array([float(row.split(",")[5]) for row in self.fmrows]) if len(self.fmrows) else np.zeros(0)
+
+    def iscPage(self, query):
+        from urllib.parse import parse_qs
+        q = parse_qs(query, keep_blank_values=True)
+        left, right = float(q.get("left_lon", [""])[0] or -180), float(q.get("right_lon", [""])[0] or 180)
+        rows = self.fmrows[(self.fmlon >= left) & (self.fmlon <= right)]
+        if not len(rows):
+            return "<html>No events were found.\n</html>"
+        return "".join(self.fmhead) + "".join(rows) + "".join(self.fmtail)
+
+    def handler(self):
+        from http.server import BaseHTTPRequestHandler
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                path, _, query = self.path.partition("?")
+                if path.startswith("/fdsnws/event/1/query"):
+                    body = stub.quakeml
+                elif path.startswith("/cgi-bin/web-db-v4"):
+                    body = stub.iscPage(query).encode()
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+###########################################################################################
+def stages(stub, xml, csv, workdir):
+    # name -> function of each benchmarked stage
+    from obspy import UTCDateTime
+    tt1, tt2 = UTCDateTime(START), UTCDateTime(START + datetime.timedelta(days=DAYS))
+    query = eqf.EventQuery(starttime=START, endtime=START + datetime.timedelta(days=DAYS), minM=0)
+    with open(xml, "rb") as f:
+        quakeml = f.read()
+    with open(csv) as f:
+        fmcsv = f.read()
+    cols = eqf.quakemlColumns(io.BytesIO(quakeml))
+    fmcols = eqf.fmcsvColumns(fmcsv)
+    txt = os.path.join(workdir, "bench_catalog.txt")
+    fmtxt = os.path.join(workdir, "bench_fm_catalog.txt")
+    eqf.saveEvents(txt, cols)
+    circle = eqf.EventQuery(starttime=START, endtime=START + datetime.timedelta(days=30), clat=22, clon=121, maxrad=10, minM=0)
+
+    def fdsnFetch():
+        from obspy.clients.fdsn import Client
+        client = Client(base_url=stub.url, _discover_services=False)
+        return eqf.fetchWindow(client, tt1, tt2, query.params())
+
+    def iscFetch():
+        frames = eqf.iscFrames(tt1, tt2, ("RECT", -90, 90, -180, 180), 0, 700, "", "", baseurl=stub.url + "/cgi-bin/web-db-v4")
+        return eqf.fmColumns(eqf.mergeFrames(frames))
+
+    def localQuery():
+        import cat_index
+        index = cat_index.CatalogIndex(eqf.eventTable(cols))
+        return index.query(circle)
+
+    def qplot():
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import cat_plot
+        cat_plot.eqqplot(txt, os.path.join(workdir, "bench_map.png"))
+        plt.close("all")
+
+    import cat_plot
+    return dict(
+        quakeml_parse=lambda: eqf.quakemlColumns(io.BytesIO(quakeml)),
+        fdsn_fetch=fdsnFetch,
+        fmcsv_parse=lambda: eqf.fmcsvColumns(fmcsv),
+        isc_fetch=iscFetch,
+        write_txt=lambda: eqf.saveEvents(txt, cols),
+        write_npz=lambda: eqf.saveTable(os.path.join(workdir, "bench_catalog.npz"), eqf.eventTable(cols), fmt="npz"),
+        write_fm_txt=lambda: eqf.saveCatalog(fmtxt, eqf.FM_CATALOG_HEADER, eqf.FM_CATALOG_ROW, fmcols),
+        cinput=lambda: cat_plot.cinput(txt),
+        local_query=localQuery,
+        qplot=qplot)
+
+def measure(func, repeat=1):
+    # (best time of repeat runs in s, peak traced memory in MB)
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak / 2.**20
+
+def run(sizes=(1000, 100000), names=STAGES, repeat=1, directory="bench_fixtures"):
+    results = []
+    stub = Stub()
+    try:
+        for size in sizes:
+            xml, csv = fixtures(directory, size)
+            stub.load(xml, csv)
+            funcs = stages(stub, xml, csv, directory)
+            for name in names:
+                try:
+                    seconds, peak = measure(funcs[name], repeat=repeat)
+                except Exception as e:
+                    print("{:>8} {:<14} failed: {}".format(size, name, e))
+                    continue
+                results.append(dict(stage=name, size=size, seconds=seconds, peak_mb=peak))
+                print("{:>8} {:<14} {:9.3f} s {:9.1f} MB".format(size, name, seconds, peak))
+    finally:
+        stub.close()
+    return dict(date=datetime.datetime.utcnow().isoformat(), python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), repeat=repeat, results=results)
+
+def compare(new, old, tolerance=TOLERANCE):
+    # print the time ratios to an older result file, return the regressed (stage, size)
+    before = dict(((r["stage"], r["size"]), r) for r in old["results"])
+    regressions = []
+    print("\n{:>8} {:<14} {:>9} {:>9} {:>7}".format("size", "stage", "old (s)", "new (s)", "ratio"))
+    for r in new["results"]:
+        o = before.get((r["stage"], r["size"]))
+        if o is None:
+            continue
+        ratio = r["seconds"] / max(o["seconds"], 1e-9)
+        flag = ""
+        if ratio > tolerance:
+            regressions.append((r["stage"], r["size"]))
+            flag = "  <- slower"
+        print("{:>8} {:<14} {:9.3f} {:9.3f} {:7.2f}{}".format(r["size"], r["stage"], o["seconds"], r["seconds"], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    opts = dict(sizes="1000/100000", repeat="1", stages="/".join(STAGES), fixtures="bench_fixtures", out="bench.json",
+                compare="", tolerance=str(TOLERANCE))
+    if len(argv) > 1:
+        for item in [x for x in argv[1].split(",") if x]:
+            key, _, val = item.partition("=")
+            if key not in opts:
+                sys.exit("Unknown parameter {}".format(key))
+            opts[key] = val
+    names = opts["stages"].split("/")
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        sys.exit("Unknown stages: {} (stages are {})".format(", ".join(unknown), "/".join(STAGES)))
+
+    result = run(sizes=[int(x) for x in opts["sizes"].split("/")], names=names, repeat=int(opts["repeat"]), directory=opts["fixtures"])
+    with open(opts["out"], "w") as f:
+        json.dump(result, f, indent=1)
+    print("Results written to {}".format(opts["out"]))
+    if opts["compare"]:
+        with open(opts["compare"]) as f:
+            regressions = compare(result, json.load(f), tolerance=float(opts["tolerance"]))
+        if regressions:
+            sys.exit("{} stage(s) slower than {}x".format(len(regressions), opts["tolerance"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import time
+import sqlite3
+import numpy as np
+import cat_events
+
+'''
+Local on-disk event store used by earthquakeFinder.py (cache=<file>).
+Events are kept in a sqlite database keyed by event ID and origin time, together with the
+time ranges that have already been downloaded and the box (lat/lon), depth range and minimum
+magnitude they were downloaded for. A query only downloads the time ranges which no covering
+box holds yet, for its own box and depth range (not the whole globe); the exact region, depth
+and magnitude filters are then answered locally. Coverage rows of older caches have no box
+or depth range (NULL) and cover the whole globe.
+
+Staleness policy: a downloaded range is trusted forever for the part that was older than
+`settle` seconds at download time. The younger part (where solutions are still revised)
+is trusted for `ttl` seconds only and downloaded again after that.
+'''
+
+TTL = 3600          # (s) how long freshly downloaded events are trusted
+SETTLE = 2*86400    # (s) age after which event solutions are not revised anymore
+GLOBE = (-90., 90., -180., 180.)
+REGION_COLUMNS = ["minlat", "maxlat", "minlon", "maxlon", "mindep", "maxdep"]
+
+
+class EventCache(object):
+    def __init__(self, path, ttl=TTL, settle=SETTLE):
+        self.path = path
+        self.ttl = ttl
+        self.settle = settle
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, time REAL, lon REAL, lat REAL, depth REAL, magtype TEXT, mag REAL, name TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_time ON events (time)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS coverage (start REAL, end REAL, minmag REAL, fetched REAL)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(coverage)")]
+        for name in REGION_COLUMNS:
+            if name not in columns:
+                self.db.execute("ALTER TABLE coverage ADD COLUMN {} REAL".format(name))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def covered(self, minmag, box=GLOBE, depth=None, now=None):
+        """
+        Time ranges which can be answered from the cache for events of magnitude >= minmag
+        inside box (minlat, maxlat, minlon, maxlon) and the depth range (km, None: all depths)
+        """
+        if now is None:
+            now = time.time()
+        sql = "SELECT start, end, fetched FROM coverage WHERE minmag <= ? AND (minlat IS NULL OR (minlat <= ? AND maxlat >= ? AND minlon <= ? AND maxlon >= ?))"
+        args = [minmag] + list(box)
+        if depth is None:
+            sql += " AND mindep IS NULL"
+        else:
+            sql += " AND (mindep IS NULL OR (mindep <= ? AND maxdep >= ?))"
+            args += list(depth)
+        ranges = []
+        for start, end, fetched in self.db.execute(sql, args):
+            if now - fetched > self.ttl:
+                end = min(end, fetched - self.settle)
+            if end > start:
+                ranges.append((start, end))
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def missing(self, start, end, minmag, box=GLOBE, depth=None, now=None):
+        """
+        Time ranges between start and end (epoch seconds) which still have to be downloaded
+        """
+        gaps = []
+        t = start
+        for cstart, cend in self.covered(minmag, box=box, depth=depth, now=now):
+            if cend <= t:
+                continue
+            if cstart >= end:
+                break
+            if cstart > t:
+                gaps.append((t, cstart))
+            t = max(t, cend)
+        if t < end:
+            gaps.append((t, end))
+        return gaps
+
+    def store(self, cols, start, end, minmag, box=GLOBE, depth=None, now=None):
+        """
+        Replace the events of magnitude >= minmag between start and end, inside box and the
+        depth range (km, None: all depths), by the downloaded events
+        cols: event records (see cat_events.EVENT_DTYPE)
+        """
+        if now is None:
+            now = time.time()
+        epoch = cols["time"].astype("datetime64[us]").astype(np.int64) / 1e6
+        rows = zip(cols["id"].tolist(), epoch.tolist(), cat_events.widen(cols, "lon").tolist(), cat_events.widen(cols, "lat").tolist(),
+                   (cat_events.widen(cols, "depth") * 1000).tolist(), cat_events.magtypes(cols).tolist(),
+                   cat_events.widen(cols, "mag").tolist(), cat_events.names(cols).tolist())
+        sql = "DELETE FROM events WHERE time >= ? AND time <= ? AND mag >= ? AND lat >= ? AND lat <= ? AND lon >= ? AND lon <= ?"
+        args = [start, end, minmag] + list(box)
+        if depth is not None:
+            sql += " AND depth >= ? AND depth <= ?"
+            args += [depth[0] * 1000, depth[1] * 1000]
+        region = list(box) + (list(depth) if depth is not None else [None, None])
+        with self.db:
+            self.db.execute(sql, args)
+            self.db.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT INTO coverage (start, end, minmag, fetched, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(", ".join(REGION_COLUMNS)),
+                            [start, end, minmag, now] + region)
+
+    def query(self, start, end, minlat=None, maxlat=None, minlon=None, maxlon=None,
+              clat=None, clon=None, minrad=None, maxrad=None, minD=None, maxD=None, minM=None, maxM=None):
+        """
+        Event records between start and end (latest first), filtered like the FDSN event service
+        depths in km, radius in degrees
+        """
+        sql = "SELECT id, time, lon, lat, depth, magtype, mag, name FROM events WHERE time >= ? AND time <= ?"
+        args = [start, end]
+        for cond, val in [("mag >= ?", minM), ("mag <= ?", maxM), ("lat >= ?", minlat), ("lat <= ?", maxlat)]:
+            if val is not None:
+                sql += " AND " + cond
+                args.append(val)
+        if minD is not None:
+            sql += " AND depth >= ?"
+            args.append(minD * 1000)
+        if maxD is not None:
+            sql += " AND depth <= ?"
+            args.append(maxD * 1000)
+        if minlon is not None and maxlon is not None:
+            #boxes crossing the dateline have minlon > maxlon
+            sql += " AND (lon >= ? {} lon <= ?)".format("AND" if minlon <= maxlon else "OR")
+            args += [minlon, maxlon]
+        sql += " ORDER BY time DESC"
+        rows = self.db.execute(sql, args).fetchall()
+        ids, times, lons, lats, deps, magtypes, mags, names = zip(*rows) if rows else [()] * 8
+        # ids are stored as text (the hash of cat_events.eventId), older caches keep the provider event IDs
+        ids = np.array([int(i) if i.lstrip("-").isdigit() else cat_events.eventId(i) for i in ids], dtype=np.int64)
+        cols = cat_events.records(ids, np.round(np.array(times, dtype=float) * 1e6).astype(np.int64).astype("datetime64[us]"),
+                                  np.array(lons, dtype=float), np.array(lats, dtype=float), np.array(deps, dtype=float) / 1000,
+                                  np.array(magtypes, dtype=str), np.array(mags, dtype=float), np.array(names, dtype=str))
+
+        if clat is not None and clon is not None:
+            lon = np.radians(cols["lon"])
+            lat = np.radians(cols["lat"])
+            lat0, lon0 = np.radians(clat), np.radians(clon)
+            cosd = np.sin(lat) * np.sin(lat0) + np.cos(lat) * np.cos(lat0) * np.cos(lon - lon0)
+            dist = np.degrees(np.arccos(np.clip(cosd, -1, 1)))
+            keep = np.ones(len(dist), dtype=bool)
+            if minrad is not None:
+                keep &= dist >= minrad
+            if maxrad is not None:
+                keep &= dist <= maxrad
+            cols = cols[keep]
+        return cols
@@ -0,0 +1,135 @@
+import hashlib
+import numpy as np
+
+'''
+Event records shared by the downloaders, the cache, the federation, the writers and the plots.
+One event is one EVENT_DTYPE record (38 bytes), an event list is an Events array (structured
+NumPy array) whose fields are read like columns (events["lat"]):
+    id       int64        hash of the provider event ID (see eventId)
+    time     datetime64   origin time (us)
+    lon, lat float32      (deg)
+    depth    float32      (km)
+    mag      float32
+    magtype  uint16       code of the magnitude type in events.magtypeValues
+    name     uint32       code of the region name in events.nameValues
+The magnitude types and region names are kept once per array in its string tables, so the
+records hold no Python objects and nothing is kept beyond the arrays which use them. Slices
+and indexed copies share the tables of their array, concat() merges them and save() writes
+them with the records. float32 keeps about 7 significant digits, widen() gives the float64
+values written to the catalogs.
+'''
+
+EVENT_DTYPE = np.dtype([("id", "<i8"), ("time", "<M8[us]"), ("lon", "<f4"), ("lat", "<f4"), ("depth", "<f4"),
+                        ("mag", "<f4"), ("magtype", "<u2"), ("name", "<u4")])
+# decimals restored by widen(): float32 holds them at the size of the values (lon 180, depth 700 km, mag 10)
+DECIMALS = dict(lon=4, lat=4, depth=4, mag=5)
+NO_VALUES = np.array([""])
+TABLES = dict(magtype="magtypeValues", name="nameValues")
+
+
+class Events(np.ndarray):
+    # EVENT_DTYPE records with the string tables of their magtype and name codes
+    def __array_finalize__(self, obj):
+        self.magtypeValues = getattr(obj, "magtypeValues", NO_VALUES)
+        self.nameValues = getattr(obj, "nameValues", NO_VALUES)
+
+    def __getitem__(self, key):
+        item = super(Events, self).__getitem__(key)
+        # a field is a plain column
+        return item.view(np.ndarray) if isinstance(key, str) else item
+
+
+def empty(n=0):
+    return np.zeros(n, dtype=EVENT_DTYPE).view(Events)
+
+def eventId(value):
+    # 64 bit hash of a provider event ID (identical IDs give identical hashes in every process)
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little", signed=True)
+
+def eventIds(values):
+    return np.array([eventId(value) for value in values], dtype=np.int64)
+
+def _mix(h):
+    # splitmix64 finalizer of uint64 values
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+def rowIds(events):
+    # 64 bit hashes of origin time, position, depth and magnitude, for events without a provider ID
+    h = _mix(events["time"].view(np.uint64))
+    for field in ("lon", "lat", "depth", "mag"):
+        h = _mix(h ^ events[field].view(np.uint32).astype(np.uint64))
+    return h.view(np.int64)
+
+def encode(values, dtype):
+    # (string table, codes) of string values
+    values = np.asarray(values, dtype=str).ravel()
+    if not len(values):
+        return NO_VALUES, np.zeros(0, dtype=dtype)
+    table, codes = np.unique(values, return_inverse=True)
+    if len(table) - 1 > np.iinfo(dtype).max:
+        raise OverflowError("More than {} distinct values".format(np.iinfo(dtype).max + 1))
+    return table, codes.ravel().astype(dtype)
+
+def records(ids, time, lon, lat, depth, magtype, mag, name):
+    """
+    Event records of columns: ids (int64 or provider ID strings), time (datetime64),
+    lon, lat, depth (km), mag (floats) and magtype, name (strings)
+    """
+    ids = np.asarray(ids)
+    events = empty(len(ids))
+    events["id"] = ids if ids.dtype.kind in "iu" else eventIds(ids.tolist())
+    events["time"] = time
+    events["lon"], events["lat"], events["depth"], events["mag"] = lon, lat, depth, mag
+    events.magtypeValues, events["magtype"] = encode(magtype, np.uint16)
+    events.nameValues, events["name"] = encode(name, np.uint32)
+    return events
+
+def concat(parts):
+    # one Events array of several, their codes are translated to the merged string tables
+    parts = [empty()] + list(parts)
+    events = np.concatenate([part.view(np.ndarray) for part in parts]).view(Events)
+    for field, attr in TABLES.items():
+        tables = [getattr(part, attr, NO_VALUES) for part in parts]
+        merged = np.unique(np.concatenate(tables))
+        events[field] = np.concatenate([np.searchsorted(merged, table)[part[field]] for table, part in zip(tables, parts)])
+        setattr(events, attr, merged)
+    return events
+
+def widen(events, field):
+    # float64 values of a float32 field, rounded to the decimals float32 holds
+    return np.round(events[field].astype(float), DECIMALS[field])
+
+def magtypes(events):
+    return getattr(events, "magtypeValues", NO_VALUES)[events["magtype"]]
+
+def names(events):
+    return getattr(events, "nameValues", NO_VALUES)[events["name"]]
+
+def fromTable(table):
+    # event records of a catalog table (dict of columns named like the catalog header, see cat_index.readCatalog)
+    import cat_index
+    n = len(table["LATITUDE"])
+    epoch = np.round(cat_index.originTimes(table) * 1e6).astype(np.int64).astype("datetime64[us]")
+    events = records(np.zeros(n, dtype=np.int64), epoch, table["LONGITUDE"], table["LATITUDE"], table["DEPTH"],
+                     table.get("MAG_TYPE", np.full(n, "")), table["MAG"], table.get("EVENT_NAME", np.full(n, "")))
+    events["id"] = rowIds(events)
+    return events
+
+def save(file, events):
+    # .npz of event records with the string tables of their codes (only the used strings)
+    out = empty(len(events))
+    out[...] = events
+    tables = {}
+    for field, attr in TABLES.items():
+        used, codes = np.unique(events[field], return_inverse=True)
+        tables[field] = getattr(events, attr, NO_VALUES)[used] if len(used) else NO_VALUES
+        out[field] = codes.ravel()
+    np.savez(file, events=out.view(np.ndarray), magtype_values=tables["magtype"], name_values=tables["name"])
+
+def load(file):
+    with np.load(file) as f:
+        events = f["events"].view(Events)
+        events.magtypeValues, events.nameValues = f["magtype_values"], f["name_values"]
+    return events
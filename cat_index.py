@@ -0,0 +1,159 @@
+import time
+import numpy as np
+
+'''
+Local query engine over catalog files written by earthquakeFinder.py (local=<file>).
+The catalog (txt, npz or parquet, with or without focal mechanisms) is loaded once and
+indexed twice:
+    time index: row numbers sorted by origin time
+    cell index: row numbers sorted by (CELL x CELL degree cell, origin time), so the events of
+                one cell inside a time range are one contiguous slice found by binary search
+A query (earthquakeFinder.EventQuery, rectangle or great-circle radius) is answered from the
+index with the fewest candidate events in the time range, the candidates are then filtered
+exactly. The cost of the last query is kept in CatalogIndex.cost.
+'''
+
+CELL = 1.   # (deg) size of the spatial cells
+NROW = int(round(180 / CELL))
+NCOL = int(round(360 / CELL))
+
+
+def readCatalog(path, columns=None):
+    # dict of the catalog columns (named like the catalog header), only the ones of columns which the catalog has when given
+    if path.endswith(".npz"):
+        with np.load(path) as f:
+            return dict((name, f[name]) for name in f.files if columns is None or name in columns)
+    import pandas as pd
+    if path.endswith(".parquet"):
+        # the column chunks are read from the mapped file
+        df = pd.read_parquet(path, memory_map=True)
+    else:
+        df = pd.read_csv(path, delimiter=' *; *', engine='python')
+    return dict((name, df[name].values) for name in df.columns if columns is None or name in columns)
+
+def originTimes(table):
+    # origin times (epoch s) of the catalog rows
+    import pandas as pd
+    minute, second = ("MIN", "SEC") if "SEC" in table else ("MINUTES", "SECONDS")
+    t = pd.to_datetime(pd.DataFrame(dict(year=table["YEAR"], month=table["MONTH"], day=table["DAY"],
+                                         hour=table["HOUR"], minute=table[minute])))
+    return t.values.astype("datetime64[us]").astype(np.int64) / 1e6 + np.asarray(table[second], dtype=float)
+
+def epochSeconds(t):
+    return (np.datetime64(t, "us") - np.datetime64(0, "us")) / np.timedelta64(1, "s")
+
+def distance(lat, lon, lat0, lon0):
+    # great-circle distance (deg)
+    lat, lon = np.radians(lat), np.radians(lon)
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    cosd = np.sin(lat) * np.sin(lat0) + np.cos(lat) * np.cos(lat0) * np.cos(lon - lon0)
+    return np.degrees(np.arccos(np.clip(cosd, -1, 1)))
+
+def cellRows(lat):
+    return np.clip(np.floor((np.asarray(lat, dtype=float) + 90) / CELL), 0, NROW - 1).astype(np.int64)
+
+def cellCols(lon):
+    lon = (np.asarray(lon, dtype=float) + 180) % 360
+    return np.clip(np.floor(lon / CELL), 0, NCOL - 1).astype(np.int64)
+
+def lonCols(minlon, maxlon):
+    # cell columns covering the longitudes minlon..maxlon (minlon > maxlon crosses the dateline)
+    if maxlon - minlon >= 360:
+        return np.arange(NCOL)
+    first, last = cellCols(minlon), cellCols(maxlon)
+    if minlon > maxlon or (last < first):
+        return np.concatenate([np.arange(first, NCOL), np.arange(0, last + 1)])
+    return np.arange(first, last + 1)
+
+
+class CatalogIndex(object):
+    def __init__(self, table):
+        self.table = table
+        self.n = len(table["LATITUDE"])
+        self.epoch = originTimes(table)
+        self.lat = np.asarray(table["LATITUDE"], dtype=float)
+        self.lon = np.asarray(table["LONGITUDE"], dtype=float)
+        self.depth = np.asarray(table["DEPTH"], dtype=float)
+        self.mag = np.asarray(table["MAG"], dtype=float)
+
+        # time index
+        self.torder = np.argsort(self.epoch, kind="stable")
+        self.tsorted = self.epoch[self.torder]
+        # cell index: key = cell * span + whole seconds since the first event
+        self.t0 = np.floor(self.tsorted[0]) if self.n else 0.
+        self.span = int(self.tsorted[-1] - self.t0) + 2 if self.n else 2
+        cell = cellRows(self.lat) * NCOL + cellCols(self.lon)
+        key = cell * self.span + np.floor(self.epoch - self.t0).astype(np.int64)
+        self.corder = np.argsort(key, kind="stable")
+        self.ckey = key[self.corder]
+        self.cost = None
+
+    @classmethod
+    def load(cls, path):
+        return cls(readCatalog(path))
+
+    def cells(self, query):
+        # cells which can contain events of the query region
+        if query.circular():
+            r = query.maxrad
+            rows = np.arange(cellRows(query.clat - r), cellRows(query.clat + r) + 1)
+            coslat = np.cos(np.radians(query.clat))
+            if r >= 90 or query.clat + r >= 90 or query.clat - r <= -90 or np.sin(np.radians(r)) >= coslat:
+                cols = np.arange(NCOL)
+            else:
+                dlon = np.degrees(np.arcsin(np.sin(np.radians(r)) / coslat))
+                cols = lonCols(query.clon - dlon, query.clon + dlon)
+        else:
+            rows = np.arange(cellRows(query.minlat), cellRows(query.maxlat) + 1)
+            cols = lonCols(query.minlon, query.maxlon)
+        return (rows[:, None] * NCOL + cols[None, :]).ravel()
+
+    def candidates(self, query, t1, t2):
+        # row numbers to check, from the time index or the cell index (whichever has less)
+        lo = np.searchsorted(self.tsorted, t1, side="left")
+        hi = np.searchsorted(self.tsorted, t2, side="right")
+        cells = self.cells(query)
+        base = cells * self.span
+        s1 = int(np.clip(np.floor(t1 - self.t0), 0, self.span - 1))
+        s2 = int(np.clip(np.floor(t2 - self.t0), s1, self.span - 1))
+        clo = np.searchsorted(self.ckey, base + s1, side="left")
+        chi = np.searchsorted(self.ckey, base + s2, side="right")
+        counts = chi - clo
+        if counts.sum() < hi - lo:
+            keep = counts > 0
+            clo, counts = clo[keep], counts[keep]
+            if not len(clo):
+                return "cell", len(cells), np.zeros(0, dtype=np.int64)
+            # concatenated aranges clo[i]..clo[i]+counts[i]
+            steps = np.ones(counts.sum(), dtype=np.int64)
+            starts = np.cumsum(counts)[:-1]
+            steps[0] = clo[0]
+            steps[starts] = clo[1:] - (clo[:-1] + counts[:-1] - 1)
+            return "cell", len(cells), self.corder[np.cumsum(steps)]
+        return "time", len(cells), self.torder[lo:hi]
+
+    def query(self, query):
+        """
+        Catalog table (dict of columns, in the order of the catalog file) of the events matching query
+        """
+        start = time.time()
+        t1, t2 = epochSeconds(query.starttime), epochSeconds(query.endtime)
+        plan, ncells, idx = self.candidates(query, t1, t2)
+        epoch, lat, lon, depth, mag = self.epoch[idx], self.lat[idx], self.lon[idx], self.depth[idx], self.mag[idx]
+        keep = (epoch >= t1) & (epoch <= t2) & (depth >= query.minD) & (depth <= query.maxD) & (mag >= query.minM) & (mag <= query.maxM)
+        if query.circular():
+            dist = distance(lat, lon, query.clat, query.clon)
+            keep &= (dist >= query.minrad) & (dist <= query.maxrad)
+        else:
+            keep &= (lat >= query.minlat) & (lat <= query.maxlat)
+            if query.minlon <= query.maxlon:
+                keep &= (lon >= query.minlon) & (lon <= query.maxlon)
+            else:
+                keep &= (lon >= query.minlon) | (lon <= query.maxlon)
+        rows = np.sort(idx[keep])
+        self.cost = dict(plan=plan, cells=ncells, candidates=len(idx), matches=len(rows), events=self.n, ms=(time.time() - start) * 1000)
+        return dict((name, np.asarray(col)[rows]) for name, col in self.table.items())
+
+    def report(self):
+        c = self.cost
+        return "{matches} of {events} events, {plan} index, {candidates} candidates checked ({cells} cells) in {ms:.2f} ms".format(**c)
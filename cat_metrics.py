@@ -0,0 +1,177 @@
+import sys
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:     # not available on windows
+    resource = None
+
+'''
+Stage level metrics of earthquakeFinder.py (metrics=<file>, profile=cpu|mem).
+Every stage of the pipeline (fetch, parse, isc_fetch, isc_parse, cache, federate, write,
+local_query, plot_read, plot_draw) adds its calls, time, bytes, events, retries and errors
+to the module level `metrics`, with the peak RSS of the process at the end of the stage
+(peak_rss) and the most one call of the stage raised it (rss_growth, nested and concurrent
+stages share it); both are gauges. They are written as JSON lines (one line per stage and a "total" line with the wall time
+and peak RSS) or as Prometheus text (file name *.prom). `metrics` is reset at the start of
+every run (runQuery, EQFinder).
+An exception raised inside a stage gets the name of the innermost stage as `stage` attribute.
+
+The profilers run around one stage at a time, nested and concurrent stages are part of the
+profiled one:
+profile=cpu runs cProfile and writes <metrics file>.<stage>.pstats.
+profile=mem traces allocations (tracemalloc) and adds the peak traced memory of each stage.
+'''
+
+FIELDS = ["calls", "seconds", "bytes", "events", "retries", "errors"]
+GAUGES = dict(traced_peak="eqfinder_stage_traced_peak_bytes", peak_rss="eqfinder_stage_peak_rss_bytes",
+              rss_growth="eqfinder_stage_rss_growth_bytes")
+
+
+def peakRSS():
+    # peak resident set size of the process (bytes)
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Metrics(object):
+    def __init__(self, profile=""):
+        self.lock = threading.Lock()
+        self.profile = profile
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.profiles = {}
+            self.profiling = False
+            self.started = time.time()
+
+    def _entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict((key, 0) for key in FIELDS)
+        return self.stages[name]
+
+    def count(self, name, **counts):
+        with self.lock:
+            entry = self._entry(name)
+            for key, val in counts.items():
+                entry[key] = entry.get(key, 0) + val
+
+    def peak(self, name, **values):
+        # largest value of every call
+        with self.lock:
+            entry = self._entry(name)
+            for key, val in values.items():
+                entry[key] = max(entry.get(key, 0), val)
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        prof = self._startProfile()
+        rss = peakRSS()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if getattr(e, "stage", None) is None:
+                try:
+                    e.stage = name
+                except AttributeError:
+                    pass
+            self.count(name, errors=1)
+            raise
+        finally:
+            peak = peakRSS()
+            self.count(name, calls=1, seconds=time.perf_counter() - start, **counts)
+            self.peak(name, peak_rss=peak, rss_growth=peak - rss)
+            self._stopProfile(name, prof)
+
+    def _startProfile(self):
+        if self.profile not in ("cpu", "mem"):
+            return None
+        with self.lock:
+            if self.profiling:
+                return None
+            self.profiling = True
+        if self.profile == "cpu":
+            import cProfile
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:    # another profiler is active
+                self.profiling = False
+                return None
+            return prof
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # no other stage is traced, so the peak is the one of this stage
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _stopProfile(self, name, prof):
+        if prof is None:
+            return
+        if self.profile == "cpu":
+            import pstats
+            prof.disable()
+            with self.lock:
+                if name in self.profiles:
+                    self.profiles[name].add(prof)
+                else:
+                    self.profiles[name] = pstats.Stats(prof)
+                self.profiling = False
+        elif self.profile == "mem":
+            import tracemalloc
+            self.peak(name, traced_peak=tracemalloc.get_traced_memory()[1] - prof)
+            with self.lock:
+                self.profiling = False
+
+    def rows(self):
+        with self.lock:
+            rows = [dict(stage=name, **entry) for name, entry in self.stages.items()]
+        rows.append(dict(stage="total", seconds=time.time() - self.started, peak_rss=peakRSS()))
+        return rows
+
+    def jsonLines(self):
+        return "".join(json.dumps(row) + "\n" for row in self.rows())
+
+    def prometheus(self):
+        rows = self.rows()
+        total = rows.pop()
+        lines = []
+        for key in FIELDS + list(GAUGES):
+            values = [(row["stage"], row[key]) for row in rows if key in row]
+            if not values:
+                continue
+            if key in GAUGES:
+                metric, kind = GAUGES[key], "gauge"
+            else:
+                metric, kind = "eqfinder_stage_{}_total".format(key), "counter"
+            lines.append("# TYPE {} {}".format(metric, kind))
+            lines += ['{}{{stage="{}"}} {}'.format(metric, stage, value) for stage, value in values]
+        lines.append("# TYPE eqfinder_run_seconds gauge")
+        lines.append("eqfinder_run_seconds {}".format(total["seconds"]))
+        lines.append("# TYPE eqfinder_peak_rss_bytes gauge")
+        lines.append("eqfinder_peak_rss_bytes {}".format(total["peak_rss"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # JSON lines, Prometheus text for *.prom, "-" for stdout; cProfile stats next to it
+        text = self.prometheus() if path.endswith(".prom") else self.jsonLines()
+        if path == "-":
+            sys.stdout.write(text)
+        else:
+            with open(path, "w") as f:
+                f.write(text)
+        prefix = "eqfinder" if path == "-" else path
+        for name, stats in self.profiles.items():
+            stats.dump_stats("{}.{}.pstats".format(prefix, name))
+
+
+metrics = Metrics()
@@ -1,17 +1,13 @@
-import obspy
-import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib as mpl
-import pandas as pd
+from functools import lru_cache
 
-from mpl_toolkits.basemap import Basemap
-from obspy.imaging.beachball import beach
-from matplotlib import cm
+#matplotlib, Basemap, obspy and pandas are imported when plotting, importing cat_plot stays cheap
 
 
 def qplot(lat=None, lon=None, dep=None, mag = None, focal = None,
             ulat=None, ulon=None, llat=None, llon=None,  scale="local",
-            min_dep = None, max_dep = None, topo = False, filename = None, minmag = None, maxmag = None
+            min_dep = None, max_dep = None, topo = False, filename = None, minmag = None, maxmag = None,
+            m = None
             ):
     """
     Earthquake (eq) Quick(q) plot the catalogue data in map.
@@ -24,6 +20,7 @@ def qplot(lat=None, lon=None, dep=None, mag = None, focal = None,
     :param ulon (float): upper right longitude of the map
     :param llat (float): lower left latitude of the map
     :param llon (float): lower left longitude of the map
+    :param m (Basemap): map projection to reuse (see basemap()), the extent is then the one of m
     dep (list): depth of the earthquakes
     mag (list): Mw of the earthquakes
     focal (list): focal mechanism of the earthquakes. From obspy documentation:
@@ -48,42 +45,50 @@ def qplot(lat=None, lon=None, dep=None, mag = None, focal = None,
     Coded by Nguyen Cong Nghia - IESAS 2017
 
     """
+    import matplotlib.pyplot as plt
+    import matplotlib as mpl
+    from matplotlib import cm
 
     fig = plt.figure(figsize=(15,15))
     ax = plt.gca()
 
-#Convert all parameters to list:
-    if type(lat) != list:
-        lat = [lat]
-        lon = [lon]
+#Convert all parameters to arrays (non-numeric values become NaN):
+    lat = _numeric(lat)
+    lon = _numeric(lon)
+    dep = _numeric(dep)
+    if mag is not None:
+        mag = _numeric(mag)
 
 #Create the local when there is no limit
     if ulat == None:
-        ulat = max(lat) + 3
+        ulat = np.nanmax(lat) + 3
     if ulon == None:
-        ulon = max(lon) + 3
+        ulon = np.nanmax(lon) + 3
     if llat == None:
-        llat = min(lat) - 3
+        llat = np.nanmin(lat) - 3
     if llon == None:
-        llon = min(lon) - 3
+        llon = np.nanmin(lon) - 3
 
-    ex_factor = np.sqrt((ulon - llon)**2 - (ulat - llat)**2)
-    if ex_factor > 200:
-        scale = "global"
 #Number of events
     n = len(lat)
 
 #Draw the basemap base on scale
-    if scale == "global":
+    if m is None:
+        m = basemap(llat, ulat, llon, ulon, scale)
+
+#Draw map boundary first: grid, continents and coastlines are clipped to the boundary of this figure (m can be reused)
+    m.drawmapboundary(zorder = 2)
+    if m.projection == "robin":
+        scale = "global"
         min_marker_size = 1
         min_width = 100000
-        m = Basemap(projection="robin", lat_0 = 0, lon_0 = 0, resolution ='c')
         m.drawparallels([-60,-30,0,30,60], labels = [True, False, True, False],zorder = 10)
         m.drawmeridians([-90,0,90], labels = [False, True, False, True],zorder = 10)
-    elif scale == "local":
+    else:
+        scale = "local"
         min_marker_size = 1.5
         min_width = 120000
-        m = Basemap(projection="merc", llcrnrlon= llon,llcrnrlat= llat, urcrnrlon= ulon, urcrnrlat=ulat, resolution ='i')
+        llat, ulat, llon, ulon = m.llcrnrlat, m.urcrnrlat, m.llcrnrlon, m.urcrnrlon
         m.drawparallels(np.arange(int(llat),int(ulat),np.ceil((ulat-llat)/5))+1, labels = [True, False, True, False],zorder = 10)
         m.drawmeridians(np.arange(int(llon),int(ulon),np.ceil((ulon-llon)/5))+1, labels = [False, True, False, True],zorder = 10)
 
@@ -94,70 +99,48 @@ def qplot(lat=None, lon=None, dep=None, mag = None, focal = None,
         m.fillcontinents(color='gray', zorder = 3)
         m.drawcoastlines(zorder = 4)
 
-#Draw map boundary, continents, coastlines and countries
-    m.drawmapboundary(zorder = 2)
+#Draw countries
     m.drawcountries(zorder = 5)
 
-#Get earthquake color
-    dep_r = [x for x in dep if isinstance(x, (int, float))]
+#Get earthquake color (black when the depth is unknown)
     if min_dep == None:
-        min_dep = min(dep_r)
-        max_dep = max(dep_r)
-    col = []
-    for i in range(0, n):
-        try:
-            col.append(cm.jet(dep[i]/max_dep))
-        except:
-            col.append([0,0,0,1])
+        min_dep = np.nanmin(dep)
+        max_dep = np.nanmax(dep)
+    col = cm.jet(dep/max_dep)
+    col[np.isnan(dep)] = [0,0,0,1]
 
 #Get earthquake size
-    msize = []
-    if mag is not None:
-        if minmag is not None:
-            minmag = min(mag)
-        if maxmag is not None:
-            maxmag = max(mag)
-
-    for i in range(0, n):
-        if mag == None:
-            msize.append(min_marker_size)
-        else:
-            try:
-                msize.append(((mag[i] - min(mag) + 1) * min_marker_size)*2)
-            except:
-                msize.append(min_marker_size*2)
+    if mag is None:
+        magmin = 0
+        msize = np.full(n, min_marker_size)
+    else:
+        magmin = np.nanmin(mag)
+        msize = ((mag - magmin + 1) * min_marker_size)*2
+        msize[np.isnan(msize)] = min_marker_size*2
 
-#Draw the earthquake
+#Draw the earthquake (one collection for all events, sizes are marker diameters like in plot)
+    x,y = m(lon, lat)
     if focal is None:
-        for i in range(0, n):
-            x,y = m(lon[i], lat[i])
-            m.plot(x, y, "o",color = col[i], zorder = 50, markersize = msize[i], markeredgecolor='black', markeredgewidth=0.01)
+        m.scatter(x, y, s = msize**2, c = col, marker = "o", zorder = 50, edgecolors='black', linewidths=0.01)
 
 #Get the focal mechanism size
     if focal is not None:
-        f_width = []
-        for i in range(0, n):
-            try:
-                f_width.append((mag[i] - min(mag) + 1)*min_width)
-            except:
-                f_width.append(min_width)
+        if mag is None:
+            f_width = np.full(n, min_width)
+        else:
+            f_width = (mag - magmin + 1)*min_width
+            f_width[np.isnan(f_width)] = min_width
 
 #Draw the focal mechanism
     if focal is not None:
-        x,y = m(lon, lat)
-        for i in range(0, n):
-            try:
-                ball = beach(focal[i], xy=(x[i], y[i]), width=f_width[i], linewidth=1, facecolor = col[i])
-                ax.add_collection(ball)
-            except:
-                pass
+        ax.add_collection(beachCollection(focal, x, y, f_width, col, ax))
 
 #Draw the point legend:
     if focal is None:
 
-        EQmag1 = ((5 - min(mag) + 1) * min_marker_size)*2  # eq magnitude 5
-        EQmag2 = ((6 - min(mag) + 1) * min_marker_size)*2  # eq magnitude 6
-        EQmag3 = ((7 - min(mag) + 1) * min_marker_size)*2  # eq magnitude 7
+        EQmag1 = ((5 - magmin + 1) * min_marker_size)*2  # eq magnitude 5
+        EQmag2 = ((6 - magmin + 1) * min_marker_size)*2  # eq magnitude 6
+        EQmag3 = ((7 - magmin + 1) * min_marker_size)*2  # eq magnitude 7
 
         m.plot([], [], "bo", markersize = EQmag1 , label='Mw = 5')
         m.plot([], [], "bo", markersize = EQmag2 , label='Mw = 6')
@@ -186,20 +169,134 @@ def qplot(lat=None, lon=None, dep=None, mag = None, focal = None,
         plt.show()
 
 
+def basemap(llat, ulat, llon, ulon, scale="local"):
+    """
+    Map projection of qplot for the extent. Building it (coastline clipping) is the expensive
+    part of a map, one Basemap can be passed to many qplot calls (m=...).
+    """
+    from mpl_toolkits.basemap import Basemap
+    ex_factor = np.sqrt((ulon - llon)**2 - (ulat - llat)**2)
+    if ex_factor > 200:
+        scale = "global"
+    if scale == "global":
+        return Basemap(projection="robin", lat_0 = 0, lon_0 = 0, resolution ='c')
+    return Basemap(projection="merc", llcrnrlon= llon,llcrnrlat= llat, urcrnrlon= ulon, urcrnrlat=ulat, resolution ='i')
+
+
+BEACH_STEP = 5         # (deg) dip/rake quantization of the cached beachballs
+BEACH_MT_STEP = 0.05   # quantization of the normalized moment tensor components
+BEACH_CACHE = 4096     # number of cached beachball glyphs
+BEACH_VERTICES = 128   # most vertices of a glyph path (obspy draws the nodal lines with ~300 each)
+
+def _beachKey(fm):
+    """
+    (glyph key, rotation (deg), fills swapped) of a mechanism. The strike only rotates the
+    beachball and rake + 180 swaps its compressional and dilatational areas, so strike/dip/rake
+    glyphs are the ones of strike 0 and a rake in [0, 180).
+    """
+    fm = np.asarray(fm, dtype=float)
+    if len(fm) == 6:
+        return tuple(np.round(fm / np.abs(fm).max() / BEACH_MT_STEP) * BEACH_MT_STEP), 0., False
+    strike, dip, rake = fm
+    rake = np.round(rake / BEACH_STEP) * BEACH_STEP % 360
+    return (0., np.round(dip / BEACH_STEP) * BEACH_STEP, rake % 180), -strike, bool(rake >= 180)
+
+@lru_cache(maxsize=BEACH_CACHE)
+def _unitBeach(key):
+    # paths of a beachball of radius 1 at (0, 0) and whether each patch is filled with the event color
+    from obspy.imaging.beachball import beach
+    ball = beach(key, xy=(0, 0), width=2, facecolor=(0, 0, 0, 1), bgcolor=(1, 1, 1, 1))
+    from matplotlib.path import Path
+    filled = ball.get_facecolors()[:, 0] == 0
+    paths = []
+    for path in ball.get_paths():
+        # every step-th vertex, the first and the closing ones are kept
+        step = int(np.ceil(len(path.vertices) / float(BEACH_VERTICES)))
+        keep = np.unique(np.r_[np.arange(0, len(path.vertices) - 1, step), len(path.vertices) - 1])
+        paths.append(Path(path.vertices[keep], None if path.codes is None else path.codes[keep]))
+    return paths, filled
+
+@lru_cache(maxsize=1)
+def _glyphCollection():
+    from matplotlib.collections import Collection
+
+    class GlyphCollection(Collection):
+        # paths drawn at offsets with one affine transform each, the paths are shared, not copied
+        def __init__(self, paths, transforms, **kwargs):
+            Collection.__init__(self, **kwargs)
+            self._paths = paths
+            self._transforms = transforms
+    return GlyphCollection
+
+def beachCollection(focal, x, y, width, color, ax, linewidth=1, zorder=100):
+    """
+    All focal mechanisms of the axes ax as one collection. Mechanisms are quantized (BEACH_STEP,
+    BEACH_MT_STEP), the glyph of each quantized mechanism is computed once and drawn rotated
+    and scaled (data units) at every event. Invalid mechanisms are skipped.
+    """
+    from matplotlib.transforms import AffineDeltaTransform
+    paths = []
+    angles = []
+    events = []
+    colors = []
+    for i in range(len(focal)):
+        try:
+            key, rotation, swapped = _beachKey(focal[i])
+            glyph, filled = _unitBeach(key)
+        except Exception:
+            continue
+        for path, fill in zip(glyph, filled):
+            paths.append(path)
+            angles.append(rotation)
+            events.append(i)
+            colors.append(color[i] if fill != swapped else (1, 1, 1, 1))
+    events = np.array(events, dtype=int)
+    angles = np.deg2rad(angles)
+    radius = np.asarray(width, dtype=float)[events] / 2.
+    transforms = np.zeros((len(events), 3, 3))
+    transforms[:, 0, 0] = transforms[:, 1, 1] = radius * np.cos(angles)
+    transforms[:, 1, 0] = radius * np.sin(angles)
+    transforms[:, 0, 1] = -transforms[:, 1, 0]
+    transforms[:, 2, 2] = 1
+    offsets = np.column_stack([np.asarray(x, dtype=float)[events], np.asarray(y, dtype=float)[events]])
+    collection = _glyphCollection()(paths, transforms, offsets=offsets, offset_transform=ax.transData,
+                                    facecolors=colors, edgecolors="k", linewidths=linewidth, zorder=zorder)
+    # radius 1 glyphs scaled in data units, without the translation of the data coordinates
+    collection.set_transform(AffineDeltaTransform(ax.transData))
+    return collection
+
+PLOT_COLUMNS = ["LONGITUDE", "LATITUDE", "DEPTH", "MAG"]
+FOCAL_COLUMNS = ["Str1", "Dip1", "Rake1"]
+
+def _numeric(values):
+    # float arrays are used as they are (float32 fields of event records included), anything else is coerced to NaN
+    values = np.atleast_1d(values)
+    if values.dtype.kind == "f":
+        return values
+    if values.dtype.kind in "iub":
+        return values.astype(float)
+    import pandas as pd
+    return np.atleast_1d(pd.to_numeric(pd.Series(values), errors="coerce").values.astype(float))
+
 def cinput(inp):
-    df = pd.read_csv(inp, delimiter=' *; *', engine='python')
-    lon = list(df['LONGITUDE'])
-    lat = list(df['LATITUDE'])
-    dep = list(df['DEPTH'])
-    mag = list(df['MAG'])
-    if 'Str1' in df.columns:
-        focal = list(df[['Str1','Dip1','Rake1']].values)
-        return lon, lat, dep, mag, focal
-    else:
-        focal = None
-        return lon, lat, dep, mag, focal
+    """
+    Read a catalog written by earthquakeFinder.py: catalog.txt, or the binary
+    catalog.npz / catalog.parquet (fmt=npz/parquet) which are loaded without text parsing.
+    lon, lat, dep, mag are float32 columns, focal is N x 3 or None.
+    """
+    import cat_index
+    table = cat_index.readCatalog(inp, columns=PLOT_COLUMNS + FOCAL_COLUMNS)
+    lon, lat, dep, mag = [_numeric(table[name]).astype(np.float32) for name in PLOT_COLUMNS]
+    focal = None
+    if 'Str1' in table:
+        focal = np.column_stack([table[name] for name in FOCAL_COLUMNS])
+    return lon, lat, dep, mag, focal
 
 def eqqplot(cata, pic):
-    lon, lat, dep, mag, focal = cinput(cata)
-    qplot(lon = lon, lat = lat, dep = dep, mag = mag, focal = focal, filename = pic)
+    from cat_metrics import metrics
+    with metrics.stage("plot_read"):
+        lon, lat, dep, mag, focal = cinput(cata)
+        metrics.count("plot_read", events=len(lon))
+    with metrics.stage("plot_draw"):
+        qplot(lon = lon, lat = lat, dep = dep, mag = mag, focal = focal, filename = pic)
 
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import cat_events
+
+'''
+Resumable downloads of earthquakeFinder.py (resume=yes for .eqfinder_resume, or resume=<directory>).
+Every completed FDSN time window (event records) and ISC tile (FMCSV response) is kept in
+<directory>/<query hash>/ and listed in its manifest.json. Parts and manifest are written to
+a temporary file which is then renamed, so an interrupted run never leaves a half written
+part behind. A rerun of the same query only downloads the windows which are not in the
+manifest yet; the directory is removed once the catalog has been written.
+
+The query hash covers the download (FDSN events or ISC focal mechanisms, so the FDSN
+fallback of a failed fm=yes download keeps the ISC tiles), the start time, region, depth and
+magnitude ranges, providers and fm, not the end time: a rerun with the default end time (now) resumes as well. Parts are keyed
+by their exact request (provider, window bounds and parameters), so only identical requests
+are answered from the checkpoint. The window length of a download is kept in the manifest
+(setting) and reused by the rerun, so its windows fall on the same grid from the start time
+and only the last one (up to the new end time) is downloaded again.
+'''
+
+RESUME_DIR = ".eqfinder_resume"
+
+
+def queryHash(query, download="events"):
+    info = dict(download=download, starttime=str(query.starttime), region=sorted((k, v) for k, v in query.params().items() if v is not None),
+                providers=list(query.providers), federate=query.federate, fm=bool(query.fm))
+    return hashlib.md5(json.dumps(info, sort_keys=True).encode()).hexdigest()[:16]
+
+def atomicWrite(path, write, mode="wb"):
+    # write(file) into a temporary file next to path, then rename it to path
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Checkpoint(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.manifest = os.path.join(directory, "manifest.json")
+        self.parts = {}
+        self.settings = {}
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+            self.parts = manifest["parts"]
+            self.settings = manifest.get("settings", {})
+        self.resumed = 0    # parts answered from the checkpoint
+        self.saved = 0      # parts checkpointed by this run
+
+    @staticmethod
+    def open(query, root=RESUME_DIR, download="events"):
+        return Checkpoint(os.path.join(root, queryHash(query, download)))
+
+    def _name(self, key):
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _path(self, key):
+        # file of a completed part, None when it is not checkpointed
+        with self.lock:
+            entry = self.parts.get(self._name(key))
+        if entry is None:
+            return None
+        path = os.path.join(self.directory, entry["file"])
+        return path if os.path.exists(path) else None
+
+    def _makedirs(self):
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+    def _writeManifest(self):
+        # called with the lock held
+        text = json.dumps(dict(parts=self.parts, settings=self.settings), indent=1)
+        atomicWrite(self.manifest, lambda f: f.write(text), mode="w")
+
+    def _commit(self, name, filename, write, mode, **info):
+        self._makedirs()
+        atomicWrite(os.path.join(self.directory, filename), write, mode=mode)
+        with self.lock:
+            self.parts[name] = dict(file=filename, saved=time.time(), **info)
+            self.saved += 1
+            self._writeManifest()
+
+    def setting(self, key, value):
+        # value of key saved by an earlier run, else value (saved for the next runs)
+        with self.lock:
+            if key in self.settings:
+                return self.settings[key]
+        self._makedirs()
+        with self.lock:
+            self.settings.setdefault(key, value)
+            self._writeManifest()
+            return self.settings[key]
+
+    def events(self, key):
+        # event records of a completed window
+        path = self._path(key)
+        if path is None:
+            return None
+        with self.lock:
+            self.resumed += 1
+        return cat_events.load(path)
+
+    def saveEvents(self, key, events):
+        name = self._name(key)
+        self._commit(name, name + ".npz", lambda f: cat_events.save(f, events), "wb", request=key, events=len(events))
+
+    def text(self, key):
+        # body of a completed response
+        path = self._path(key)
+        if path is None:
+            return None
+        with self.lock:
+            self.resumed += 1
+        with open(path) as f:
+            return f.read()
+
+    def saveText(self, key, text):
+        name = self._name(key)
+        self._commit(name, name + ".txt", lambda f: f.write(text), "w", request=key)
+
+    def report(self):
+        return "{} parts resumed, {} checkpointed in {}".format(self.resumed, self.saved, self.directory)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        root = os.path.dirname(self.directory)
+        if os.path.isdir(root) and not os.listdir(root):
+            os.rmdir(root)
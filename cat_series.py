@@ -0,0 +1,164 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Map series of a catalog: one qplot map per extent and per time slice, rendered by a pool
+of processes.
+The catalog columns are written once as .npy files which every worker maps read-only
+(np.load(mmap_mode="r")), so the events are not pickled to the workers. The maps are
+sharded by extent: a worker builds the Basemap of its extent once and draws all the time
+slices of that extent with it. When there are fewer extents than workers, the slices of an
+extent are split over several workers (each building its own Basemap).
+
+# Examples:
+## one map per month of the whole catalog with 8 processes
+python3 cat_series.py catalog=catalog.txt,period=month,workers=8
+
+## one map per region (one line per region in regions.txt) and per year
+python3 cat_series.py catalog=catalog.txt,extents=regions.txt,period=year,out=maps
+
+regions.txt (mnlo > mxlo, or mxlo > 180, crosses the dateline):
+name=taiwan,mnla=20,mxla=27,mnlo=118,mxlo=124
+name=japan,mnla=30,mxla=46,mnlo=128,mxlo=146
+name=fiji,mnla=-25,mxla=-10,mnlo=170,mxlo=-170
+
+Parameters (default values in the braces):
+catalog(catalog.txt),extents(none: the extent of the catalog),period(all, month or year),out(maps),workers(number of cores)
+'''
+
+COLUMNS = ["epoch", "lon", "lat", "dep", "mag"]
+
+
+def shareColumns(table, directory):
+    # write the catalog columns (sorted by origin time) as .npy files for the workers
+    import cat_index
+    epoch = cat_index.originTimes(table)
+    order = np.argsort(epoch, kind="stable")
+    cols = dict(epoch=epoch, lon=table["LONGITUDE"], lat=table["LATITUDE"], dep=table["DEPTH"], mag=table["MAG"])
+    if "Str1" in table:
+        cols["focal"] = np.column_stack([table["Str1"], table["Dip1"], table["Rake1"]])
+    for name, col in cols.items():
+        np.save(os.path.join(directory, name + ".npy"), np.asarray(col, dtype=float)[order])
+    return len(epoch), "focal" in cols
+
+def loadColumns(directory):
+    cols = dict((name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")) for name in COLUMNS)
+    path = os.path.join(directory, "focal.npy")
+    cols["focal"] = np.load(path, mmap_mode="r") if os.path.exists(path) else None
+    return cols
+
+def readExtents(path):
+    # [(name, llat, ulat, llon, ulon)] from lines name=..,mnla=..,mxla=..,mnlo=..,mxlo=..
+    extents = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = dict(x.split("=") for x in line.split(",") if x)
+            extents.append((item.get("name", "extent{}".format(n)), float(item["mnla"]), float(item["mxla"]),
+                            float(item["mnlo"]), float(item["mxlo"])))
+    return extents
+
+def timeSlices(epoch, period):
+    # [(label, start, end)] epoch seconds of the calendar months/years covering the catalog
+    if period == "all" or not len(epoch):
+        return [("all", -np.inf, np.inf)]
+    unit = dict(month="M", year="Y")[period]
+    t = np.array([epoch[0], epoch[-1]]) * 1e6
+    first, last = t.astype(np.int64).astype("datetime64[us]").astype("datetime64[{}]".format(unit))
+    edges = np.arange(first, last + 2)
+    seconds = edges.astype("datetime64[us]").astype(np.int64) / 1e6
+    return [(str(edges[i]), seconds[i], seconds[i + 1]) for i in range(len(edges) - 1)]
+
+def renderMaps(directory, extent, frames, out, min_dep, max_dep):
+    """
+    Worker: draw the time slices (frames) of one extent, with one Basemap for all of them
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import cat_plot
+    cols = loadColumns(directory)
+    name, llat, ulat, llon, ulon = extent
+    if ulon < llon:
+        # crossing the dateline (e.g. mnlo=170,mxlo=-170), drawn as 170..190
+        ulon += 360
+    m = cat_plot.basemap(llat, ulat, llon, ulon)
+    written = []
+    for label, t1, t2 in frames:
+        lo, hi = np.searchsorted(cols["epoch"], [t1, t2], side="left")
+        lat = cols["lat"][lo:hi]
+        # longitudes in llon..llon+360, so that extents beyond +-180 keep their events
+        lon = llon + (cols["lon"][lo:hi] - llon) % 360
+        keep = (lat >= llat) & (lat <= ulat) & (lon <= ulon)
+        if not keep.any():
+            continue
+        focal = cols["focal"][lo:hi][keep] if cols["focal"] is not None else None
+        filename = os.path.join(out, "{}_{}.png".format(name, label))
+        cat_plot.qplot(lat=lat[keep], lon=lon[keep], dep=cols["dep"][lo:hi][keep], mag=cols["mag"][lo:hi][keep],
+                       focal=focal, min_dep=min_dep, max_dep=max_dep, filename=filename, m=m)
+        plt.close("all")
+        written.append(filename)
+    return written
+
+def renderSeries(table, extents=None, period="all", out="maps", nworkers=None):
+    """
+    Draw the map series of a catalog table (dict of catalog columns): one map per extent
+    (name, llat, ulat, llon, ulon) and time slice, in nworkers processes. Returns the files written.
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    directory = tempfile.mkdtemp(prefix="eqseries")
+    try:
+        n, hasfocal = shareColumns(table, directory)
+        cols = loadColumns(directory)
+        if not extents:
+            # the extent qplot would choose for the whole catalog
+            extents = [("catalog", np.nanmin(cols["lat"]) - 3, np.nanmax(cols["lat"]) + 3, np.nanmin(cols["lon"]) - 3, np.nanmax(cols["lon"]) + 3)]
+        frames = timeSlices(cols["epoch"], period)
+        min_dep, max_dep = float(np.nanmin(cols["dep"])), float(np.nanmax(cols["dep"]))
+        # shards: all the frames of an extent, split when there are fewer extents than workers
+        nsplit = max(1, min(len(frames), nworkers // len(extents)))
+        shards = [(extent, frames[i::nsplit]) for extent in extents for i in range(nsplit)]
+        print("Drawing {} maps ({} extents x {} time slices) of {} events with {} processes".format(
+              len(extents) * len(frames), len(extents), len(frames), n, nworkers))
+        written = []
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            jobs = dict((pool.submit(renderMaps, directory, extent, shard, out, min_dep, max_dep), extent[0]) for extent, shard in shards)
+            for job in as_completed(jobs):
+                try:
+                    written += job.result()
+                except Exception as e:
+                    print("Failed to draw the maps of {}: {}".format(jobs[job], e))
+        return sorted(written)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    opts = dict(catalog="catalog.txt", extents="", period="all", out="maps", workers="")
+    if len(argv) > 1:
+        for item in [x for x in argv[1].split(",") if x]:
+            key, _, val = item.partition("=")
+            if key not in opts:
+                sys.exit("Unknown parameter {}".format(key))
+            opts[key] = val
+    if opts["period"] not in ("all", "month", "year"):
+        sys.exit("period should be all, month or year")
+    import cat_index
+    table = cat_index.readCatalog(opts["catalog"])
+    extents = readExtents(opts["extents"]) if opts["extents"] else None
+    written = renderSeries(table, extents=extents, period=opts["period"], out=opts["out"],
+                           nworkers=int(opts["workers"]) if opts["workers"] else None)
+    print("{} maps written to {}".format(len(written), opts["out"]))
+
+if __name__ == "__main__":
+    main()
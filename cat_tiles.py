@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+from functools import lru_cache
+
+'''
+Tiled map output for large catalogs: XYZ (web mercator, z/x/y.png, 256 px) tiles.
+For every zoom level the events are aggregated into a density grid of BIN x BIN pixel
+cells (number of events, mean depth, largest magnitude), only the cells are drawn: the
+colour is the mean depth, the opacity grows with the number of events and the magnitude.
+
+The base layer (land, lakes and coastlines from Basemap) is extracted once per coastline
+resolution into <out>/base/coast_<res>.npz, the base image of every tile is kept in
+<out>/base/z/x/y.png. Every tile of the pyramid up to the highest zoom level is written:
+tiles without events are a copy of their base image, so a map viewer never misses a tile.
+<out>/tiles.json keeps a digest of the density grid of every tile, so a new run only draws
+the tiles whose events changed.
+
+# Examples:
+python3 cat_tiles.py catalog=catalog.txt,out=tiles,zoom=6
+python3 earthquakeFinder.py st=2000/1,tiles=tiles          (tiles instead of EQmap.png)
+python3 earthquakeFinder.py watch=60,tiles=tiles           (tiles updated after each poll)
+'''
+
+TILE = 256                # (px) tile size
+BIN = 4                   # (px) density grid cell size
+NBIN = TILE // BIN
+MAXLAT = 85.0511287798    # latitude limit of the web mercator tiles
+MAXZOOM = 6
+DEPTH_MAX = 700.          # (km) depth of the last colour of the depth scale
+LAND = (0.5, 0.5, 0.5, 1)
+WATER = (0.87, 0.93, 1, 1)
+VERSION = 1               # drawing version, part of the tile digests
+
+
+def pixels(lon, lat, zoom):
+    # global web mercator pixel coordinates at the zoom level
+    size = TILE * 2**zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAXLAT, MAXLAT))
+    x = (np.asarray(lon, dtype=float) + 180) / 360 * size
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * size
+    return np.clip(x, 0, size - 1e-6), np.clip(y, 0, size - 1e-6)
+
+def resolution(zoom):
+    # coastline resolution of the zoom level
+    return "c" if zoom <= 2 else ("l" if zoom <= 5 else "i")
+
+
+###########################################################################################
+def densityGrids(lon, lat, depth, mag, zoom):
+    """
+    Density grid of the zoom level, per tile (x, y): (cell numbers, count, depth sum, number of depths, largest magnitude)
+    of the occupied BIN x BIN pixel cells of the tile
+    """
+    ok = np.isfinite(lon) & np.isfinite(lat)
+    x, y = pixels(lon[ok], lat[ok], zoom)
+    ncell = 2**zoom * NBIN
+    cells, inv = np.unique((y // BIN).astype(np.int64) * ncell + (x // BIN).astype(np.int64), return_inverse=True)
+    inv = inv.ravel()
+    depth, mag = depth[ok], mag[ok]
+    count = np.bincount(inv, minlength=len(cells))
+    dsum = np.bincount(inv, weights=np.nan_to_num(depth), minlength=len(cells))
+    dnum = np.bincount(inv, weights=np.isfinite(depth), minlength=len(cells))
+    mmax = np.full(len(cells), -np.inf)
+    np.maximum.at(mmax, inv, np.where(np.isfinite(mag), mag, -np.inf))
+
+    row, col = cells // ncell, cells % ncell
+    tile = (row // NBIN) * 2**zoom + col // NBIN
+    local = (row % NBIN) * NBIN + col % NBIN
+    order = np.argsort(tile, kind="stable")
+    tiles, starts = np.unique(tile[order], return_index=True)
+    grids = {}
+    for t, idx in zip(tiles.tolist(), np.split(order, starts[1:])):
+        grids[(t % 2**zoom, t // 2**zoom)] = (local[idx], count[idx], dsum[idx], dnum[idx], mmax[idx])
+    return grids
+
+def digest(grid):
+    h = hashlib.md5(str(VERSION).encode())
+    for arr in grid:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+def overlay(grid):
+    # RGBA image (TILE x TILE, floats) of the density grid of one tile
+    from matplotlib import cm
+    local, count, dsum, dnum, mmax = grid
+    rgba = np.zeros((NBIN * NBIN, 4))
+    mean = np.where(dnum > 0, dsum / np.maximum(dnum, 1), np.nan)
+    rgba[local] = cm.jet(np.clip(mean / DEPTH_MAX, 0, 1))
+    rgba[local[np.isnan(mean)]] = (0, 0, 0, 1)
+    boost = np.clip(np.where(np.isfinite(mmax), mmax, 0) - 4, 0, 4) * 0.05
+    rgba[local, 3] = np.clip(0.25 + 0.12 * np.log2(count) + boost, 0, 1)
+    rgba = rgba.reshape(NBIN, NBIN, 4)
+    return np.repeat(np.repeat(rgba, BIN, axis=0), BIN, axis=1)
+
+
+###########################################################################################
+#Base layer
+class BaseLayer(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.canvas = None    # one figure for all the tiles drawn
+
+    @lru_cache(maxsize=None)
+    def coast(self, res):
+        """
+        Land and lake polygons of the coastline resolution: (zoom 0 pixel vertices, polygon offsets, types, bounding boxes)
+        """
+        path = os.path.join(self.directory, "coast_{}.npz".format(res))
+        if not os.path.exists(path):
+            from mpl_toolkits.basemap import Basemap
+            m = Basemap(projection="merc", llcrnrlat=-MAXLAT, urcrnrlat=MAXLAT, llcrnrlon=-180, urcrnrlon=180, resolution=res)
+            verts = []
+            for xs, ys in m.coastpolygons:
+                lon, lat = m(np.asarray(xs), np.asarray(ys), inverse=True)
+                verts.append(np.column_stack(pixels(lon, lat, 0)))
+            offsets = np.cumsum([0] + [len(v) for v in verts])
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            np.savez(path, verts=np.concatenate(verts), offsets=offsets, types=np.asarray(m.coastpolygontypes))
+        with np.load(path) as f:
+            verts, offsets, types = f["verts"], f["offsets"], f["types"]
+        polys = np.split(verts, offsets[1:-1])
+        boxes = np.array([(p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()) for p in polys])
+        return polys, types, boxes
+
+    def file(self, zoom, x, y):
+        # base image file of the tile, drawn once and kept on disk
+        import matplotlib.image as mpimg
+        path = os.path.join(self.directory, str(zoom), str(x), "{}.png".format(y))
+        if not os.path.exists(path):
+            img = self.draw(zoom, x, y)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            mpimg.imsave(path, img)
+        return path
+
+    def image(self, zoom, x, y):
+        # base image of the tile (RGBA floats)
+        import matplotlib.image as mpimg
+        return mpimg.imread(self.file(zoom, x, y))
+
+    def draw(self, zoom, x, y):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import PolyCollection
+        polys, types, boxes = self.coast(resolution(zoom))
+        scale = 2**zoom
+        x0, y0 = x * TILE, y * TILE
+        # polygons overlapping the tile (in zoom 0 pixels)
+        hit = np.nonzero((boxes[:, 2] * scale >= x0) & (boxes[:, 0] * scale <= x0 + TILE) &
+                         (boxes[:, 3] * scale >= y0) & (boxes[:, 1] * scale <= y0 + TILE))[0]
+        if self.canvas is None:
+            fig = Figure(figsize=(TILE / 100., TILE / 100.), dpi=100)
+            self.canvas = FigureCanvasAgg(fig)
+            fig.patch.set_facecolor(WATER)
+            fig.add_axes([0, 0, 1, 1]).set_axis_off()
+        ax = self.canvas.figure.axes[0]
+        for collection in list(ax.collections):
+            collection.remove()
+        ax.set_xlim(x0, x0 + TILE)
+        ax.set_ylim(y0 + TILE, y0)
+        if len(hit):
+            colors = [LAND if types[i] % 2 else WATER for i in hit]
+            ax.add_collection(PolyCollection([polys[i] * scale for i in hit], facecolors=colors, edgecolors="k", linewidths=0.4))
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba(), dtype=float) / 255.
+
+
+###########################################################################################
+def renderTiles(table, out, maxzoom=MAXZOOM, minzoom=0):
+    """
+    Draw the XYZ tiles of a catalog table (dict of catalog columns) into out/z/x/y.png,
+    tiles without events get their base image. Tiles whose density grid did not change
+    since the last run are kept.
+    """
+    import shutil
+    import matplotlib.image as mpimg
+    lon, lat = np.asarray(table["LONGITUDE"], dtype=float), np.asarray(table["LATITUDE"], dtype=float)
+    depth, mag = np.asarray(table["DEPTH"], dtype=float), np.asarray(table["MAG"], dtype=float)
+    statefile = os.path.join(out, "tiles.json")
+    state = {}
+    if os.path.exists(statefile):
+        with open(statefile) as f:
+            state = json.load(f)
+    base = BaseLayer(os.path.join(out, "base"))
+    tiles = {}
+    drawn = blank = 0
+    empty = digest([])
+    for zoom in range(minzoom, maxzoom + 1):
+        grids = densityGrids(lon, lat, depth, mag, zoom)
+        for x in range(2**zoom):
+            for y in range(2**zoom):
+                name = "{}/{}/{}".format(zoom, x, y)
+                grid = grids.get((x, y))
+                tiles[name] = empty if grid is None else digest(grid)
+                path = os.path.join(out, name + ".png")
+                if state.get(name) == tiles[name] and os.path.exists(path):
+                    continue
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                if grid is None:
+                    shutil.copyfile(base.file(zoom, x, y), path)
+                    blank += 1
+                    continue
+                img = base.image(zoom, x, y)[:, :, :3]
+                top = overlay(grid)
+                alpha = top[:, :, 3:]
+                mpimg.imsave(path, np.clip(img * (1 - alpha) + top[:, :, :3] * alpha, 0, 1))
+                drawn += 1
+    removed = [name for name in state if name not in tiles]
+    for name in removed:
+        path = os.path.join(out, name + ".png")
+        if os.path.exists(path):
+            os.remove(path)
+    with open(statefile, "w") as f:
+        json.dump(tiles, f)
+    return dict(tiles=len(tiles), drawn=drawn, blank=blank, removed=len(removed))
+
+def catalogTiles(catalog, out, maxzoom=MAXZOOM):
+    import cat_index
+    from cat_metrics import metrics
+    with metrics.stage("tiles"):
+        table = cat_index.readCatalog(catalog)
+        done = renderTiles(table, out, maxzoom=maxzoom)
+        metrics.count("tiles", events=len(table["LATITUDE"]))
+    print("{tiles} tiles in {out}: {drawn} drawn, {blank} without events, {removed} removed".format(out=out, **done))
+    return done
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    opts = dict(catalog="catalog.txt", out="tiles", zoom=str(MAXZOOM))
+    if len(argv) > 1:
+        for item in [x for x in argv[1].split(",") if x]:
+            key, _, val = item.partition("=")
+            if key not in opts:
+                sys.exit("Unknown parameter {}".format(key))
+            opts[key] = val
+    catalogTiles(opts["catalog"], opts["out"], maxzoom=int(opts["zoom"]))
+
+if __name__ == "__main__":
+    main()
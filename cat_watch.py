@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import numpy as np
+import cat_cache
+import earthquakeFinder as eqf
+
+'''
+Watch mode of earthquakeFinder.py (watch=<seconds>).
+The providers are polled every `interval` seconds in one long running process. Each poll
+only asks for the origin times after the latest event seen (minus `lookback` for late
+and revised solutions) and, after the first poll, only for the events updated since the
+previous poll (FDSN updatedafter). New or revised events are appended to the text catalog
+and emitted as JSON lines on stdout or to the clients of a local socket:
+    emit=stdout, emit=tcp:127.0.0.1:8765, emit=unix:/tmp/eqfinder.sock
+A revised event is appended again, the last line of an event is its latest solution.
+With tiles=<directory> the map tiles of the catalog are updated after each poll with new
+events (only the changed tiles are drawn again, see cat_tiles).
+'''
+
+POLL = 60                    # (s) default polling interval
+LOOKBACK = cat_cache.SETTLE  # (s) origin times before the latest event which are polled again
+UPDATE_SKEW = 60             # (s) margin on updatedafter for clock differences with the provider
+
+
+def parseEmit(emit):
+    if not emit or emit == "stdout":
+        return ("stdout",)
+    kind, _, where = emit.partition(":")
+    if kind == "tcp":
+        host, _, port = where.rpartition(":")
+        return ("tcp", host or "127.0.0.1", int(port))
+    if kind == "unix":
+        return ("unix", where)
+    raise ValueError("emit should be stdout, tcp:<host>:<port> or unix:<path>")
+
+
+class Watcher(object):
+    def __init__(self, query, interval=POLL, emit="stdout", sources=None, lookback=LOOKBACK, tiles=""):
+        if query.fmt != "txt":
+            raise ValueError("watch mode appends to a text catalog, use fmt=txt")
+        self.query = query
+        self.interval = interval
+        self.emit = parseEmit(emit)
+        self.sources = sources if sources is not None else eqf.makeProviders(query.providers)
+        self.lookback = lookback
+        self.tiles = tiles
+        self.seen = {}        # event id (hash) -> (origin time, catalog line) of the last emitted solution
+        self.latest = None    # (epoch s) high-water mark of the origin times
+        self.updated = None   # (epoch s) start of the last successful poll
+        self.clients = set()
+
+    def fetch(self, start, end, params):
+        from obspy import UTCDateTime
+        t1, t2 = UTCDateTime(start), UTCDateTime(end)
+        if len(self.sources) > 1:
+            return eqf.federatedEvents(self.sources, t1, t2, params, mode=self.query.federate)
+        return self.sources[0].fetch(t1, t2, params)
+
+    def poll(self, now=None):
+        """
+        One (blocking) polling cycle: list of (catalog line, event dict) of the new or revised events
+        """
+        from obspy import UTCDateTime
+        if now is None:
+            now = time.time()
+        start = self.query.times()[0].timestamp
+        if self.latest is not None:
+            start = max(start, self.latest - self.lookback)
+        params = self.query.params()
+        if self.updated is not None:
+            params["updatedafter"] = UTCDateTime(self.updated - UPDATE_SKEW)
+        cols = self.fetch(start, now, params)
+
+        table = eqf.eventTable(cols)
+        epoch = cols["time"].astype("datetime64[us]").astype(np.int64) / 1e6
+        rows = zip(cols["id"].tolist(), epoch.tolist(), *[table[name].tolist() for name in eqf.CATALOG_NAMES])
+        events = []
+        for row in sorted(rows, key=lambda row: row[1]):
+            line = eqf.CATALOG_ROW % row[2:]
+            old = self.seen.get(row[0])
+            if old is not None and old[1] == line:
+                continue
+            self.seen[row[0]] = (row[1], line)
+            event = dict(zip(eqf.CATALOG_NAMES, row[2:]), ID=row[0], STATUS="revised" if old else "new")
+            events.append((line, event))
+        if len(epoch):
+            self.latest = max(self.latest or start, epoch.max())
+        self.updated = now
+
+        # events older than the next polled range will not come back
+        oldest = self.latest - self.lookback if self.latest is not None else start
+        self.seen = dict((key, val) for key, val in self.seen.items() if val[0] >= oldest)
+        return events
+
+    def publish(self, events):
+        if not events:
+            return
+        out = self.query.outfile
+        with open(out, "a") as f:
+            if f.tell() == 0:
+                f.write(eqf.CATALOG_HEADER)
+            f.writelines(line for line, event in events)
+        data = "".join(json.dumps(event) + "\n" for line, event in events)
+        if self.emit[0] == "stdout":
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        for writer in list(self.clients):
+            if writer.is_closing():
+                self.clients.discard(writer)
+            else:
+                writer.write(data.encode())
+
+    async def connected(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            await reader.read()   # clients only listen, wait for them to hang up
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        if self.emit[0] == "tcp":
+            return await asyncio.start_server(self.connected, self.emit[1], self.emit[2])
+        if self.emit[0] == "unix":
+            if os.path.exists(self.emit[1]):
+                os.remove(self.emit[1])
+            return await asyncio.start_unix_server(self.connected, self.emit[1])
+        return None
+
+    async def run(self, cycles=None):
+        """
+        Poll until interrupted (or for `cycles` polls); the next poll starts `interval` s after the previous one started
+        """
+        loop = asyncio.get_running_loop()
+        server = await self.serve()
+        n = 0
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    events = await loop.run_in_executor(None, self.poll, t0)
+                except Exception as e:
+                    print("Poll failed: {}".format(e), file=sys.stderr)
+                    events = []
+                self.publish(events)
+                if events and self.tiles:
+                    import cat_tiles
+                    await loop.run_in_executor(None, cat_tiles.catalogTiles, self.query.outfile, self.tiles)
+                n += 1
+                if cycles is not None and n >= cycles:
+                    break
+                await asyncio.sleep(max(self.interval - (time.time() - t0), 0))
+        finally:
+            if server is not None:
+                server.close()
+                for writer in list(self.clients):
+                    writer.close()
+                await server.wait_closed()
+
+
+def watch(query, interval=POLL, emit="stdout", cycles=None, tiles=""):
+    watcher = Watcher(query, interval=interval, emit=emit, tiles=tiles)
+    print("Watching for new events every {} s, output: {} ({})".format(interval, query.outfile, ":".join(map(str, watcher.emit))), file=sys.stderr)
+    try:
+        asyncio.run(watcher.run(cycles=cycles))
+    except KeyboardInterrupt:
+        pass
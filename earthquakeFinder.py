@@ -1,14 +1,18 @@
 from __future__ import print_function
-import requests
 import os
-import pandas as pd
 import numpy as np
 import datetime
 import sys
-import csv
-from obspy import UTCDateTime
-from obspy.clients.fdsn import Client
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xml.etree.ElementTree as ET
+import io
 import warnings
+import cat_cache
+import cat_events
+import cat_resume
+from cat_metrics import metrics
 '''
 This program is handy for downloading the earthquake informations and catalog for given input.
 If the user call the program without any input then it will run for the default parameters.
@@ -43,15 +47,50 @@ python3 earthquakeFinder.py mxmag=9,mnmag=4,fm=yes
 ## to obtain catalog for magnitude 4-7, and within radius of 10 (default) and central coordinates 22(lat),121(lon) with focal mechanism
 python3 earthquakeFinder.py mxmag=7,mnmag=4,clat=22,clon=121,mxrad=80,fm=yes
 
+## to download a long time range in parallel time windows with 8 workers
+python3 earthquakeFinder.py st=2000/1,mnmag=5,workers=8
+
+## to keep the downloaded events in a local cache and only download the missing time ranges next time
+python3 earthquakeFinder.py clat=22,clon=121,mxrad=5,cache=eqcache.db
+
+## to write the catalog as typed binary columns (catalog.npz), fmt=parquet needs pyarrow
+python3 earthquakeFinder.py st=2016/3,fmt=npz
+
+## to query several providers at once and merge their catalogs (federate=first keeps the fastest answer)
+python3 earthquakeFinder.py providers=IRIS/USGS/EMSC/ISC,federate=merge
+
+## to keep running and append the new (or revised) events every 60 s, also sent as JSON lines to a local socket
+python3 earthquakeFinder.py st=2024/1,mnmag=2,watch=60,emit=tcp:127.0.0.1:8765
+
+## to answer the query from a catalog file downloaded before (txt, npz or parquet) instead of the providers
+python3 earthquakeFinder.py st=2000/1,clat=22,clon=121,mxrad=2,mnmag=5,local=world.npz,outfile=taiwan.txt
+
+## to write the time, bytes, events and retries of every stage as Prometheus text (JSON lines without .prom) and cProfile each stage
+python3 earthquakeFinder.py st=2016/3,metrics=run.prom,profile=cpu
+
+## to run the queries of a file (one key=value,... line per query) with 4 queries at a time, overlapping queries share one download
+python3 earthquakeFinder.py batch=regions.txt,workers=4
+
+## to draw XYZ map tiles (tiles/z/x/y.png, zoom 0-6) of the catalog instead of EQmap.png, a new run only redraws the changed tiles
+python3 earthquakeFinder.py st=2000/1,mnmag=5,tiles=tiles
+
+## to checkpoint every completed time window (in .eqfinder_resume, or resume=<directory>), running the same query again after a failure resumes the download
+python3 earthquakeFinder.py st=2000/1,mnmag=5,workers=8,resume=yes
+
+## to use it from python (nothing is downloaded or printed on import)
+import earthquakeFinder as eqf
+query = eqf.EventQuery(starttime=datetime.datetime(2016, 3, 29), minM=5, clat=22, clon=121, maxrad=5)
+table = eqf.find_events(query)    # dict of catalog columns named like the catalog.txt header
+eqf.saveTable("catalog.txt", table)
+
 Parameters to change (default values in the braces):
-mnla(-90),mxla(90),mnlo(-180),mxlo(180),mndep(0),mxdep(700),mnmag(4),mxmag(10),mnrad(0),mxrad(10),clat(None),clon(None),st(-1 month),et (current time),fm(no)
+mnla(-90),mxla(90),mnlo(-180),mxlo(180),mndep(0),mxdep(700),mnmag(4),mxmag(10),mnrad(0),mxrad(10),clat(None),clon(None),st(-1 month),et (current time),fm(no),workers(1),cache(none),ttl(1 hour),fmt(txt),providers(IRIS),federate(merge),watch(off),emit(stdout),local(none),metrics(none),profile(none),batch(none),tiles(none),resume(no)
 -Utpal Kumar
 '''
+#pandas, obspy and requests are imported in the functions which need them
 ###########################################################################################
-warnings.filterwarnings("ignore")
 sug='''Parameters to change (default values in the braces):
-mnla(-90),mxla(90),mnlo(-180),mxlo(180),mndep(0),mxdep(700),mnmag(4),mxmag(10),mnrad(0),mxrad(10),clat(None),clon(None),st(-1 month),et (current time),fm(no)\n'''
-print(sug)
+mnla(-90),mxla(90),mnlo(-180),mxlo(180),mndep(0),mxdep(700),mnmag(4),mxmag(10),mnrad(0),mxrad(10),clat(None),clon(None),st(-1 month),et (current time),fm(no),workers(1),cache(none),ttl(1 hour),fmt(txt),providers(IRIS),federate(merge),watch(off),emit(stdout),local(none),metrics(none),profile(none),batch(none),tiles(none),resume(no)\n'''
 
 def monthdelta(date, delta):
     m, y = (date.month+delta) % 12, date.year + ((date.month)+delta-1) // 12
@@ -61,258 +100,806 @@ def monthdelta(date, delta):
     return date.replace(day=d,month=m, year=y)
 ###########################################################################################
 def num_events(out):
+    if out.endswith(".npz"):
+        return len(np.load(out)["YEAR"])
+    if out.endswith(".parquet"):
+        import pandas as pd
+        return len(pd.read_parquet(out, columns=["YEAR"]))
     with open(out) as f:
         for i, l in enumerate(f):
             pass
     return i
 ###########################################################################################
+class EventQuery(object):
+    """
+    Parameters of one catalog search.
+    starttime, endtime: datetime (UTC), default: one month ago until now
+    depths in km, radii in degrees; the search is circular when clat and clon are given
+    fm: focal mechanisms from ISC (falls back to the event providers when ISC fails)
+    watch: polling interval (s) of the watch mode, 0 downloads once
+    local: catalog file to search instead of the providers (see cat_index)
+    metrics, profile: stage metrics file and profiler (cpu or mem) of the run (see cat_metrics)
+    batch: file of queries to run instead of this one (see cat_batch)
+    tiles: directory of the XYZ map tiles drawn instead of EQmap.png (see cat_tiles)
+    resume: directory of the download checkpoints, "" (default) downloads without checkpoints (see cat_resume)
+    """
+    def __init__(self, starttime=None, endtime=None, minlat=-90, maxlat=90, minlon=-180, maxlon=180,
+                 clat=None, clon=None, minrad=0, maxrad=10, minD=0, maxD=700, minM=4, maxM=10, fm=False,
+                 outfile="catalog.txt", fmt="txt", nworkers=1, cache="", ttl=cat_cache.TTL,
+                 providers=("IRIS",), federate="merge", watch=0, emit="stdout", local="", metrics="", profile="", batch="", tiles="",
+                 resume=""):
+        now = datetime.datetime.utcnow()
+        self.starttime = starttime if starttime is not None else monthdelta(now, -1)
+        self.endtime = endtime if endtime is not None else now
+        self.minlat, self.maxlat, self.minlon, self.maxlon = float(minlat), float(maxlat), float(minlon), float(maxlon)
+        self.clat = None if clat in (None, "") else float(clat)
+        self.clon = None if clon in (None, "") else float(clon)
+        self.minrad, self.maxrad = float(minrad), float(maxrad)
+        self.minD, self.maxD = float(minD), float(maxD)
+        self.minM, self.maxM = float(minM), float(maxM)
+        self.fm = fm
+        self.outfile = outfile
+        self.fmt = fmt
+        self.nworkers = nworkers
+        self.cache = cache
+        self.ttl = ttl
+        self.providers = list(providers)
+        self.federate = federate
+        self.watch = watch
+        self.emit = emit
+        self.local = local
+        self.metrics = metrics
+        self.profile = profile
+        self.batch = batch
+        self.tiles = tiles
+        self.resume = resume
 
-out = 'catalog.txt'
-
-#Time input
-now=datetime.datetime.utcnow()
-before=monthdelta(now,-1)
-
-startT=before
-endT=now
-#starting time values
-stv=[startT.year,startT.month,startT.day,startT.hour,startT.minute,startT.second]
-etv=[endT.year,endT.month,endT.day,endT.hour,endT.minute,endT.second]
-# For rectangular search
-mnlat = "-90"
-mxlat = "90"
-mnlon = "-180"
-mxlon = "180"
-
-# For circular search
-minrad ="0"
-maxrad="10"
-clat=""
-clon=""
-# Depths
-mnD = "0"
-mxD = "700"
-
-# magnitudes
-mnM = "4"
-mxM = "10"
-
-#focal mechanism solution
-fm="no"
+    def circular(self):
+        return self.clat is not None and self.clon is not None
+
+    def params(self):
+        # FDSN event service parameters
+        if self.circular():
+            region = dict(minlatitude=None, maxlatitude=None, minlongitude=None, maxlongitude=None,
+                          latitude=self.clat, longitude=self.clon, minradius=self.minrad, maxradius=self.maxrad)
+        else:
+            region = dict(minlatitude=self.minlat, maxlatitude=self.maxlat, minlongitude=self.minlon, maxlongitude=self.maxlon,
+                          latitude=None, longitude=None, minradius=None, maxradius=None)
+        region.update(mindepth=self.minD, maxdepth=self.maxD, minmagnitude=self.minM, maxmagnitude=self.maxM)
+        return region
+
+    def times(self):
+        from obspy import UTCDateTime
+        return UTCDateTime(self.starttime), UTCDateTime(self.endtime)
+
+    def bounds(self):
+        return regionBounds(self.params())
+
+def regionBounds(params):
+    # (minlat, maxlat, minlon, maxlon) around the region of FDSN params, all longitudes when it crosses the dateline
+    if params.get("latitude") is not None:
+        clat, clon, r = params["latitude"], params["longitude"], params["maxradius"]
+        minlat, maxlat = max(clat - r, -90.), min(clat + r, 90.)
+        coslat = np.cos(np.radians(clat))
+        if minlat <= -90 or maxlat >= 90 or np.sin(np.radians(min(r, 90))) >= coslat:
+            return minlat, maxlat, -180., 180.
+        dlon = float(np.degrees(np.arcsin(np.sin(np.radians(r)) / coslat)))
+        minlon, maxlon = clon - dlon, clon + dlon
+    else:
+        minlat, maxlat, minlon, maxlon = params["minlatitude"], params["maxlatitude"], params["minlongitude"], params["maxlongitude"]
+    if minlon > maxlon or minlon < -180 or maxlon > 180:
+        return minlat, maxlat, -180., 180.
+    return minlat, maxlat, minlon, maxlon
 ###########################################################################################
-#Reading the user inputs
-th=1
-try:
-    if len(sys.argv)>th:
-        userInput=sys.argv[th].split(",")
-        for item in userInput:
+def parseTime(value, default):
+    # "2016/3/29" overrides the leading fields (year/month/day/hour/minute/second) of default
+    fields = [default.year, default.month, default.day, default.hour, default.minute, default.second]
+    given = value.split("/")
+    fields[0:len(given)] = given
+    sec = float(fields[5])
+    return datetime.datetime(int(fields[0]), int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]), int(sec), int(round((sec - int(sec)) * 1e6)))
+
+def parseArgs(arg, strict=False):
+    """
+    EventQuery from the command line syntax: key=value pairs separated by commas (see sug).
+    A malformed argument gives the default query, or raises ValueError with strict=True.
+    """
+    keys = dict(mnla="minlat", mxla="maxlat", mnlo="minlon", mxlo="maxlon", mndep="minD", mxdep="maxD", mnmag="minM", mxmag="maxM",
+                mxrad="maxrad", mnrad="minrad", clat="clat", clon="clon", cache="cache", federate="federate", outfile="outfile", fmt="fmt", emit="emit", local="local", metrics="metrics", profile="profile", batch="batch", tiles="tiles")
+    query = EventQuery()
+    kwargs = {}
+    try:
+        for item in [x for x in arg.split(",") if x]:
             itmkey=item.split("=")[0]
             itmval=item.split("=")[1]
-            if itmkey=="mnla":
-                mnlat=itmval
-            elif itmkey=="mxla":
-                mxlat=itmval
-            elif itmkey=="mnlo":
-                mnlon=itmval
-            elif itmkey=="mxlo":
-                mxlon=itmval
-            elif itmkey=="mndep":
-                mnD=itmval
-            elif itmkey=="mxdep":
-                mxD=itmval
-            elif itmkey=="mnmag":
-                mnM=itmval
-            elif itmkey=="mxmag":
-                mxM=itmval
-            elif itmkey=="mxrad":
-                maxrad=itmval
-            elif itmkey=="mnrad":
-                minrad=itmval
-            elif itmkey=="clat":
-                clat=itmval
-            elif itmkey=="clon":
-                clon=itmval
+            if itmkey in keys:
+                kwargs[keys[itmkey]]=itmval
             elif itmkey=="st":
-                nw=itmval.split("/")
-                stv[0:len(nw)]=itmval.split("/")
+                kwargs["starttime"]=parseTime(itmval, query.starttime)
             elif itmkey=="et":
-                ett=itmval.split("/")
-                etv[0:len(ett)]=itmval.split("/")
+                kwargs["endtime"]=parseTime(itmval, query.endtime)
             elif itmkey=="fm":
-                fm=itmval
+                kwargs["fm"]=itmval=="yes"
                 print("Obtaining Focal Mechanism")
-            elif itmkey=="outfile":
-                out=itmval
-                print("Output catalog file is {}".format(out))
-    # makes the values lesser than 10, 2-digit
-    for i in np.arange(len(stv)):
-        if int(stv[i]) < 10:
-            stv[i] = "%02d" % int(stv[i])
-        if int(etv[i]) < 10:
-            etv[i] = "%02d" % int(etv[i])
-except:
-    print("ERROR: Please enter the proper format!\n")
+            elif itmkey=="workers":
+                kwargs["nworkers"]=int(itmval)
+            elif itmkey=="ttl":
+                kwargs["ttl"]=float(itmval)*3600
+            elif itmkey=="providers":
+                kwargs["providers"]=itmval.split("/")
+            elif itmkey=="watch":
+                kwargs["watch"]=float(itmval)
+            elif itmkey=="resume":
+                kwargs["resume"]=dict(yes=cat_resume.RESUME_DIR, no="", none="").get(itmval, itmval)
+            elif strict:
+                raise KeyError("unknown parameter {}".format(itmkey))
+        if "outfile" in kwargs:
+            print("Output catalog file is {}".format(kwargs["outfile"]))
+        elif "local" in kwargs:
+            kwargs["outfile"] = "subset." + kwargs.get("fmt", "txt")
+        elif kwargs.get("fmt", "txt") != "txt":
+            kwargs["outfile"] = "catalog." + kwargs["fmt"]
+        query = EventQuery(**kwargs)
+    except Exception as e:
+        if strict:
+            raise ValueError("Please enter the proper format! ({})".format(e))
+        print("ERROR: Please enter the proper format! ({})\n".format(e))
+    return query
+
+def printQuery(query):
+    print("Start time: {}".format(query.starttime.strftime("%Y/%m/%d/%H/%M/%S")))
+    print("End time: {}".format(query.endtime.strftime("%Y/%m/%d/%H/%M/%S")))
+    if query.circular():
+        print("\nSearching for circular region:")
+        print("Min radius= {}".format(query.minrad))
+        print("Max radius= {}".format(query.maxrad))
+        print("Central latitude= {}".format(query.clat))
+        print("Central longitude= {}".format(query.clon))
+    else:
+        print("\nSearching for rectangular region:")
+        print("Min latitude= {}".format(query.minlat))
+        print("Max latitude= {}".format(query.maxlat))
+        print("Min longitude= {}".format(query.minlon))
+        print("Max longitude= {}\n".format(query.maxlon))
+    print("Min depth= {}".format(query.minD))
+    print("Max depth= {}".format(query.maxD))
+    print("Min magnitude= {}".format(query.minM))
+    print("Max magnitude= {}\n".format(query.maxM))
 ###########################################################################################
+#Time-window chunked downloads
+WINDOW_EVENTS = 2000    # number of events targeted per time window
+PROBE_LENGTH = 7*86400  # length (s) of the first window used to estimate the event density
+MIN_WINDOW = 3600       # shortest time window (s)
+WINDOW_RETRIES = 3
 
+def timeWindows(tt1, tt2, length):
+    windows = []
+    t = tt1
+    while t < tt2:
+        windows.append((t, min(t + length, tt2)))
+        t = t + length
+    return windows
 
-print("Start time: {}/{}/{}/{}/{}/{}".format(stv[0],stv[1],stv[2],stv[3],stv[4],stv[5]))
-print("End time: {}/{}/{}/{}/{}/{}".format(etv[0],etv[1],etv[2],etv[3],etv[4],etv[5]))
-if clat and clon:
-    print("\nSearching for circular region:")
-    print("Min radius= {}".format(float(minrad)))
-    print("Max radius= {}".format(float(maxrad)))
-    print("Central latitude= {}".format(float(clat)))
-    print("Central longitude= {}".format(float(clon)))
-else:
-    print("\nSearching for rectangular region:")
-    print("Min latitude= {}".format(float(mnlat)))
-    print("Max latitude= {}".format(float(mxlat)))
-    print("Min longitude= {}".format(float(mnlon)))
-    print("Max longitude= {}\n".format(float(mxlon)))
-print("Min depth= {}".format(mnD))
-print("Max depth= {}".format(mxD))
-print("Min magnitude= {}".format(mnM))
-print("Max magnitude= {}\n".format(mxM))
-
-if os.path.exists(out):
-    os.remove(out)
+def fetchWindow(client, t1, t2, params, retries=WINDOW_RETRIES, checkpoint=None):
+    # checkpoint: completed windows are answered from it and every new window is added to it
+    key = "{} {} {} {}".format(client.base_url, t1, t2, sorted(params.items()))
+    if checkpoint is not None:
+        cols = checkpoint.events(key)
+        if cols is not None:
+            return cols
+    for attempt in range(retries):
+        if attempt:
+            metrics.count("fetch", retries=1)
+        try:
+            cols = fetchColumns(client, starttime=t1, endtime=t2, **params)
+            break
+        except Exception as e:
+            err = e
+    else:
+        raise err
+    if checkpoint is not None:
+        checkpoint.saveEvents(key, cols)
+    return cols
+
+def chunkedEvents(client, tt1, tt2, params, nworkers=4, target=WINDOW_EVENTS, checkpoint=None):
+    # the first window doubles as a probe for the event density of the query
+    probe_end = min(tt1 + PROBE_LENGTH, tt2)
+    first = fetchWindow(client, tt1, probe_end, params, checkpoint=checkpoint)
+    rate = max(len(first["id"]), 1) / max(probe_end - tt1, 1.)
+    length = min(max(target / rate, MIN_WINDOW), max((tt2 - probe_end) / nworkers, MIN_WINDOW))
+    if checkpoint is not None:
+        # the window length of the first run: a rerun with a later end time gets the same windows
+        length = checkpoint.setting("window {} {}".format(client.base_url, sorted(params.items())), length)
+    windows = timeWindows(probe_end, tt2, length)
+    print("Fetching {} time windows of {:.1f} days with {} workers".format(len(windows) + 1, length / 86400., nworkers))
+
+    results = [first]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        jobs = [(w, pool.submit(fetchWindow, client, w[0], w[1], params, checkpoint=checkpoint)) for w in windows]
+        for w, job in jobs:
+            try:
+                results.append(job.result())
+            except Exception as e:
+                failed += 1
+                print("Failed to fetch the window {} - {} in the {} stage: {}".format(w[0], w[1], getattr(e, "stage", "fetch"), e))
+    if failed:
+        # no partial catalog: with resume=... the completed windows are checkpointed and a rerun fetches only the failed ones
+        raise RuntimeError("{} of {} time windows failed".format(failed, len(windows) + 1))
+    return mergeColumns(results)
 ###########################################################################################
-def catalogDownloader(yearS=int(stv[0]), monthS=int(stv[1]), dayS=int(stv[2]), hourS=int(stv[3]), minuteS=int(stv[4]), secondS=float(stv[5]), yearE=int(etv[0]), monthE=int(etv[1]), dayE=int(etv[2]), hourE=int(etv[3]), minuteE=int(etv[4]),secondE=float(etv[5]),minlat=mnlat, maxlat=mxlat, minlon=mnlon, maxlon=mxlon,clat=clat,clon=clon,minrad=minrad,maxrad=maxrad, minD=float(mnD)*1000, maxD=float(mxD)*1000, minM=float(mnM), maxM=float(mxM)):
-    if clat and clon:
-        minlat=None
-        maxlat=None
-        minlon=None
-        maxlon=None
-        minrad=int(minrad)
-        clat=float(clat)
-        clon=float(clon)
-        maxrad=int(maxrad)
+#Event records: QuakeML is streamed straight into cat_events.EVENT_DTYPE arrays, no obspy Catalog is built
+
+def mergeColumns(results):
+    # windows share their end points, so the same event can be returned twice
+    cols = cat_events.concat(results)
+    ids, first = np.unique(cols["id"], return_index=True)
+    cols = cols[np.sort(first)]
+    # same ordering as a single request (latest first)
+    return cols[np.argsort(cols["time"], kind="stable")[::-1]]
+
+def timeFields(t):
+    # year, month, day, hour, minute, (integer) second of datetime64 values
+    year = t.astype("datetime64[Y]").astype(int) + 1970
+    month = t.astype("datetime64[M]").astype(int) % 12 + 1
+    day = (t.astype("datetime64[D]") - t.astype("datetime64[M]")).astype(int) + 1
+    sec = (t.astype("datetime64[s]") - t.astype("datetime64[D]")).astype(int)
+    return year, month, day, sec // 3600, sec // 60 % 60, sec % 60
+
+def _pick(elems, public_id):
+    for elem in elems:
+        if elem.get("publicID") == public_id:
+            return elem
+    return elems[0] if elems else None
+
+def quakemlColumns(source):
+    """
+    Incrementally parse a QuakeML document (file name or file object) into event records.
+    Only the preferred origin, preferred magnitude and the first description of each event are read,
+    every event element is dropped as soon as it has been parsed.
+    """
+    ids, times, lons, lats, deps, magtypes, mags, names = [], [], [], [], [], [], [], []
+    def value(elem, path, ns):
+        if elem is None:
+            return None
+        return elem.findtext("{0}%s/{0}value".format(ns) % path)
+
+    context = ET.iterparse(source, events=("start", "end"))
+    for action, elem in context:
+        if action == "start" and elem.tag.endswith("}eventParameters"):
+            root = elem
+        if action != "end" or not elem.tag.endswith("}event"):
+            continue
+        ns = elem.tag[:-len("event")]
+        origin = _pick(elem.findall(ns + "origin"), elem.findtext(ns + "preferredOriginID"))
+        magnitude = _pick(elem.findall(ns + "magnitude"), elem.findtext(ns + "preferredMagnitudeID"))
+        ids.append(cat_events.eventId(elem.get("publicID")))
+        times.append(value(origin, "time", ns).rstrip("Z"))
+        lons.append(value(origin, "longitude", ns))
+        lats.append(value(origin, "latitude", ns))
+        deps.append(value(origin, "depth", ns))
+        magtypes.append(magnitude.findtext(ns + "type", "") if magnitude is not None else "")
+        mags.append(value(magnitude, "mag", ns))
+        names.append(elem.findtext("{0}description/{0}text".format(ns), ""))
+        root.clear()
+
+    def floats(vals):
+        return np.array([np.nan if v is None else v for v in vals], dtype=float)
+    return cat_events.records(np.array(ids, dtype=np.int64), np.array(times, dtype="datetime64[us]"), floats(lons), floats(lats),
+                              floats(deps) / 1000, magtypes, floats(mags), names)
+
+def fetchColumns(client, **params):
+    # raw QuakeML response of the FDSN event service, parsed without building an obspy Catalog
+    from obspy.clients.fdsn.header import FDSNNoDataException
+    buf = io.BytesIO()
+    with metrics.stage("fetch"):
+        try:
+            client.get_events(filename=buf, **params)
+        except FDSNNoDataException:
+            return cat_events.empty()
+        metrics.count("fetch", bytes=buf.tell())
+    buf.seek(0)
+    with metrics.stage("parse"):
+        cols = quakemlColumns(buf)
+        metrics.count("parse", events=len(cols["id"]))
+    return cols
+###########################################################################################
+def cachedEvents(cachefile, tt1, tt2, params, fetch, ttl=cat_cache.TTL):
+    # download the uncovered time ranges of the region box and depth range of the query, filter locally
+    from obspy import UTCDateTime
+    cache = cat_cache.EventCache(cachefile, ttl=ttl)
+    minM = params["minmagnitude"]
+    box = regionBounds(params)
+    depth = (params["mindepth"], params["maxdepth"])
+    region = dict(minlatitude=box[0], maxlatitude=box[1], minlongitude=box[2], maxlongitude=box[3],
+                  mindepth=depth[0], maxdepth=depth[1], minmagnitude=minM)
+    for start, end in cache.missing(tt1.timestamp, tt2.timestamp, minM, box=box, depth=depth):
+        t1, t2 = UTCDateTime(start), UTCDateTime(end)
+        print("Downloading {} - {} (not cached)".format(t1, t2))
+        cache.store(fetch(t1, t2, region), start, end, minM, box=box, depth=depth)
+    with metrics.stage("cache"):
+        cols = cache.query(tt1.timestamp, tt2.timestamp, minlat=params["minlatitude"], maxlat=params["maxlatitude"], minlon=params["minlongitude"], maxlon=params["maxlongitude"],
+                           clat=params["latitude"], clon=params["longitude"], minrad=params["minradius"], maxrad=params["maxradius"],
+                           minD=params["mindepth"], maxD=params["maxdepth"], minM=minM, maxM=params["maxmagnitude"])
+        metrics.count("cache", events=len(cols["id"]))
+    cache.close()
+    return cols
+###########################################################################################
+#Catalog writer: the columns are formatted in bulk with one %-format per row
+CATALOG_HEADER = "YEAR;MONTH;DAY;HOUR;MINUTES;SECONDS;LONGITUDE;LATITUDE;DEPTH;MAG_TYPE;MAG;EVENT_NAME\n"
+CATALOG_ROW = "%4d;%2d;%2d;%2d;%2d;%5.2f;%9.4f;%9.4f;%5.1f;%-5s;%3.1f;%s\n"
+FM_CATALOG_HEADER = "YEAR; MONTH; DAY; HOUR; MIN; SEC; LONGITUDE; LATITUDE; DEPTH; EXP(Nm); M0; MAG; Mrr; Mtt; Mpp; Mrt; Mtp; Mpr; Str1; Dip1; Rake1; Str2; Dip2; Rake2\n"
+FM_CATALOG_ROW = "%4d;%2d;%2d;%2d;%2d;%5.2f;%9.4f;%9.4f;%5.1f;%2d;%5.3f;%3.1f;%6.3f;%6.3f;%6.3f;%6.3f;%6.3f;%6.3f;% 7.2f;%5.2f;%7.2f;%7.2f;%5.2f;%7.2f\n"
+WRITE_CHUNK = 100000
+
+def writeRows(file, rowfmt, columns):
+    # columns: one array per field of rowfmt
+    rows = zip(*[np.asarray(col).tolist() for col in columns])
+    file.write("".join(map(rowfmt.__mod__, rows)))
+
+def writeCatalog(outfile, header, rowfmt, columns, chunk=WRITE_CHUNK):
+    with open(outfile, 'w') as file:
+        file.write(header)
+        for i in range(0, len(columns[0]), chunk):
+            writeRows(file, rowfmt, [col[i:i + chunk] for col in columns])
+
+def replaceFile(outfile, write):
+    # write(path) into outfile.tmp which is renamed to outfile when complete, a failed write leaves no partial catalog
+    tmp = outfile + ".tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def saveCatalog(outfile, header, rowfmt, columns, fmt="txt"):
+    with metrics.stage("write", events=len(columns[0])):
+        replaceFile(outfile, lambda path: writeTable(path, header, rowfmt, columns, fmt=fmt))
+        metrics.count("write", bytes=os.path.getsize(outfile))
+
+def writeTable(outfile, header, rowfmt, columns, fmt="txt"):
+    # binary formats keep the typed columns under the names of the text header
+    if fmt == "txt":
+        return writeCatalog(outfile, header, rowfmt, columns)
+    names = [name.strip() for name in header.split(";")]
+    table = dict((name, np.asarray(col)) for name, col in zip(names, columns))
+    if fmt == "npz":
+        # strings read from a text catalog are object columns (NaN when missing), np.load refuses pickled arrays
+        for name, col in table.items():
+            if col.dtype == object:
+                import pandas as pd
+                table[name] = np.where(pd.isnull(col), "", col).astype(str)
+        # uncompressed, so loading a column is a plain read of its .npy member
+        with open(outfile, 'wb') as file:
+            np.savez(file, **table)
+    elif fmt == "parquet":
+        import pandas as pd
+        pd.DataFrame(table).to_parquet(outfile, index=False)
     else:
-        minlat=float(minlat)
-        maxlat=float(maxlat)
-        minlon=float(minlon)
-        maxlon=float(maxlon)
-        minrad=None
-        clat=None
-        clon=None
-        maxrad=None
+        raise ValueError("Unknown catalog format {}".format(fmt))
+###########################################################################################
+CATALOG_NAMES = [name.strip() for name in CATALOG_HEADER.split(";")]
+FM_CATALOG_NAMES = [name.strip() for name in FM_CATALOG_HEADER.split(";")]
+
+def eventTable(cols):
+    # catalog table (columns named like the catalog.txt header) of event records
+    year, month, day, hour, minute, second = timeFields(cols["time"])
+    return dict(zip(CATALOG_NAMES, [year, month, day, hour, minute, second, cat_events.widen(cols, "lon"), cat_events.widen(cols, "lat"),
+                                    cat_events.widen(cols, "depth"), cat_events.magtypes(cols), cat_events.widen(cols, "mag"), cat_events.names(cols)]))
+
+def saveTable(outfile, table, fmt="txt"):
+    if "Str1" in table:
+        return saveCatalog(outfile, FM_CATALOG_HEADER, FM_CATALOG_ROW, [table[name] for name in FM_CATALOG_NAMES], fmt=fmt)
+    return saveCatalog(outfile, CATALOG_HEADER, CATALOG_ROW, [table[name] for name in CATALOG_NAMES], fmt=fmt)
+
+def saveEvents(outfile, events, fmt="txt"):
+    # catalog file of event records, the text catalog is converted (and its strings decoded) chunk by chunk
+    if fmt != "txt":
+        return saveTable(outfile, eventTable(events), fmt=fmt)
+    def write(path):
+        with open(path, 'w') as file:
+            file.write(CATALOG_HEADER)
+            for i in range(0, len(events), WRITE_CHUNK):
+                table = eventTable(events[i:i + WRITE_CHUNK])
+                writeRows(file, CATALOG_ROW, [table[name] for name in CATALOG_NAMES])
+    with metrics.stage("write", events=len(events)):
+        replaceFile(outfile, write)
+        metrics.count("write", bytes=os.path.getsize(outfile))
+
+def queryEvents(query, sources=None, checkpoint=None):
+    # event records of the query from its providers (and cache), sources: providers to reuse
+    tt1, tt2 = query.times()
+    params = query.params()
+    if sources is None:
+        sources = makeProviders(query.providers, nworkers=query.nworkers, checkpoint=checkpoint)
+    if len(sources) > 1:
+        fetch = lambda t1, t2, p: federatedEvents(sources, t1, t2, p, mode=query.federate)
+    else:
+        fetch = sources[0].fetch
+    if query.cache:
+        return cachedEvents(query.cache, tt1, tt2, params, fetch, ttl=query.ttl)
+    return fetch(tt1, tt2, params)
+
+def openCheckpoint(query, download="events"):
+    # checkpoint of the downloads of the query (None with resume=no), download="events" or "isc"
+    if not query.resume:
+        return None
+    checkpoint = cat_resume.Checkpoint.open(query, root=query.resume, download=download)
+    if checkpoint.parts:
+        print("Resuming the download from {} ({} completed parts)".format(checkpoint.directory, len(checkpoint.parts)))
+    return checkpoint
+
+def catalogDownloader(query):
+    checkpoint = openCheckpoint(query)
     try:
-        tt1=UTCDateTime("{}-{}-{}T{}:{}:{}".format(yearS,monthS,int(dayS),hourS,minuteS,secondS))
-        tt2=UTCDateTime("{}-{}-{}T{}:{}:{}".format(yearE,monthE,int(dayE),hourE,minuteE,secondE))
-        client = Client("IRIS")
-        catalog = client.get_events(starttime=tt1, endtime=tt2,minlatitude=minlat,maxlatitude=maxlat, minlongitude=minlon, maxlongitude=maxlon, latitude=clat, longitude=clon, minradius=minrad, maxradius=maxrad, mindepth=minD, maxdepth=maxD, minmagnitude=minM, maxmagnitude=maxM)
-        eventinfo = [[] for i in range(len(catalog))]
-
-        for i in np.arange(len(catalog)):
-            arr = eventinfo[i]
-            event = catalog[i]
-            arr.append(event.origins[0]["time"].year)
-            arr.append(event.origins[0]["time"].month)
-            arr.append(event.origins[0]["time"].day)
-            arr.append(event.origins[0]["time"].hour)
-            arr.append(event.origins[0]["time"].minute)
-            arr.append(event.origins[0]["time"].second)
-            arr.append(event.origins[0]["longitude"])
-            arr.append(event.origins[0]["latitude"])
-            arr.append(event.origins[0]["depth"])
-            arr.append(event.magnitudes[0]["magnitude_type"])
-            arr.append(event.magnitudes[0]["mag"])
-            arr.append(event.event_descriptions[0].text)
-        # print(eventinfo)
-        outcatalog = "catalog.txt"
-        frmt = "YEAR;MONTH;DAY;HOUR;MINUTES;SECONDS;LONGITUDE;LATITUDE;DEPTH;MAG_TYPE;MAG;EVENT_NAME\n"
-        with open(outcatalog, 'w') as file:
-            file.write(frmt)
-            for i in range(len(eventinfo)):
-                out = "{:4d};{:2d};{:2d};{:2d};{:2d};{:5.2f};{:9.4f};{:9.4f};{:5.1f};{:5s};{:3.1f};{}".format(int(eventinfo[i][0]), int(eventinfo[i][1]), int(eventinfo[i][2]), int(eventinfo[i][3]), int(eventinfo[i][4]), float(eventinfo[i][5]), float(eventinfo[i][6]), float(eventinfo[i][7]), float(eventinfo[i][8]) / 1000, str(eventinfo[i][9]), float(eventinfo[i][10]), str(eventinfo[i][11]))
-                # print(out)
-                file.write(out + "\n")
-    except:
-        print("Failed to fetch the data! Try some other parameters")
+        saveEvents(query.outfile, queryEvents(query, checkpoint=checkpoint), fmt=query.fmt)
+    except Exception as e:
+        print("Failed to fetch the data in the {} stage ({})! Try some other parameters".format(getattr(e, "stage", "fetch"), e))
+        if checkpoint is not None and checkpoint.parts:
+            print("{}, run the same query again to resume".format(checkpoint.report()))
+        return
+    if checkpoint is not None:
+        checkpoint.remove()
+###########################################################################################
+#ISC FMCSV response: the CSV block sits between the EVENT_ID header line and the closing </pre>
+FM_REQUIRED = [2, 3, 4, 5, 6, 9, 10, 11, 13]   # rows missing any of these fields are dropped
+FM_DATA = [5, 4, 6, 9, 10, 11, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24]
+
+def fmcsvFrame(text):
+    """
+    Focal mechanism rows (with a parsed "time" column) of the body of an ISC FMCSV response,
+    None when no events were found.
+    """
+    import pandas as pd
+    if "No events were found." in text:
+        return None
+    head = text.find("EVENT_ID")
+    if head < 0:
+        raise ValueError("No FMCSV block in the ISC response")
+    start = text.find("\n", head) + 1
+    end = text.find("</pre>", start)
+    block = text[start:end if end >= 0 else len(text)].strip("\n")
+    df = pd.read_csv(io.StringIO(block), header=None, skipinitialspace=True)
+    df.dropna(subset=FM_REQUIRED, inplace=True)
+    df["time"] = pd.to_datetime(df[2].str.strip() + "T" + df[3].str.strip(), format="ISO8601")
+    return df
+
+def fmColumns(df):
+    # columns of the focal mechanism catalog in FM_CATALOG_HEADER order
+    t = df["time"]
+    columns = [t.dt.year.values, t.dt.month.values, t.dt.day.values, t.dt.hour.values, t.dt.minute.values,
+               t.dt.second.values + t.dt.microsecond.values / 1e6]
+    for idx in FM_DATA:
+        columns.append(df[idx].astype(float).values)
+    return columns
+
+def fmcsvColumns(text):
+    df = fmcsvFrame(text)
+    return None if df is None else fmColumns(df)
 ###########################################################################################
-def catalogDownloaderISC(yearS=stv[0], monthS=stv[1], dayS=stv[2], hourS=stv[3], minuteS=stv[4], secondS=stv[5], yearE=etv[0], monthE=etv[1], dayE=etv[2], hourE=etv[3], minuteE=etv[4],secondE=etv[5],minlat=mnlat, maxlat=mxlat, minlon=mnlon, maxlon=mxlon, minD=mnD, maxD=mxD, minM=mnM, maxM=mxM,maxrad=maxrad,clat=clat,clon=clon, outfile=out):
-    if clat and clon:
-        minlat=""
-        maxlat=""
-        minlon=""
-        maxlon=""
-        clat=int(clat)
-        clon=int(clon)
-        maxrad=int(maxrad)
+#Tiled ISC focal mechanism downloads over a pooled HTTP session
+ISC_URL = "http://isc-mirror.iris.washington.edu/cgi-bin/web-db-v4"
+ISC_TILE_DAYS = 180     # longest time range of one ISC request
+ISC_TILE_LON = 120      # widest longitude range of one rectangular ISC request
+ISC_TIMEOUT = 300       # (s)
+ISC_RETRIES = 3
+ISC_BACKOFF = 2         # (s) doubled after every failed attempt
+
+def iscSession(nworkers=1):
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(nworkers, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def iscUrl(t1, t2, region, minD, maxD, minM, maxM, baseurl=ISC_URL):
+    # region: ("RECT", minlat, maxlat, minlon, maxlon) or ("CIRC", clat, clon, maxrad)
+    url1 = baseurl + "?request=COMPREHENSIVE&out_format=FMCSV&"
+    if region[0] == "CIRC":
         url2 = "searchshape=CIRC&"
+        url3 = "bot_lat=&top_lat=&left_lon=&right_lon=&"
+        url4 = "ctr_lat={}&ctr_lon={}&radius={}&max_dist_units=deg&srn=&grn=&".format(*region[1:])
     else:
-        minlat=float(minlat)
-        maxlat=float(maxlat)
-        minlon=float(minlon)
-        maxlon=float(maxlon)
-        minrad=""
-        clat=""
-        clon=""
-        maxrad=""
         url2 = "searchshape=RECT&"
-    url1 = "http://isc-mirror.iris.washington.edu/cgi-bin/web-db-v4?request=COMPREHENSIVE&out_format=FMCSV&"
-    # url2 = "searchshape=RECT&"
-    url3 = "bot_lat={}&top_lat={}&left_lon={}&right_lon={}&".format(minlat, maxlat, minlon, maxlon)
-    url4 = "ctr_lat={}&ctr_lon={}&radius={}&max_dist_units=deg&srn=&grn=&".format(clat,clon,maxrad)
-    url5 = "start_year={}&start_month={}&start_day={}&start_time={}%3A{}%3A{}&end_year={}&end_month={}&end_day={}&end_time={}%3A{}%3A{}&".format(yearS, monthS, dayS, hourS, minuteS, secondS, yearE, monthE, dayE, hourE, minuteE, secondE)
+        url3 = "bot_lat={}&top_lat={}&left_lon={}&right_lon={}&".format(*region[1:])
+        url4 = "ctr_lat=&ctr_lon=&radius=&max_dist_units=deg&srn=&grn=&"
+    url5 = "start_year={}&start_month={:02d}&start_day={:02d}&start_time={:02d}%3A{:02d}%3A{:02d}&end_year={}&end_month={:02d}&end_day={:02d}&end_time={:02d}%3A{:02d}%3A{:02d}&".format(
+        t1.year, t1.month, t1.day, t1.hour, t1.minute, t1.second, t2.year, t2.month, t2.day, t2.hour, t2.minute, t2.second)
     url6 = "min_dep={}&max_dep={}&min_mag={}&max_mag={}&req_mag_type=&req_mag_agcy=&include_links=off".format(minD, maxD, minM, maxM)
+    return url1 + url2 + url3 + url4 + url5 + url6
+
+def iscTiles(tt1, tt2, region):
+    windows = timeWindows(tt1, tt2, ISC_TILE_DAYS * 86400)
+    if region[0] == "CIRC":
+        return [(w, region) for w in windows]
+    minlat, maxlat, minlon, maxlon = region[1:]
+    nlon = max(int(np.ceil((maxlon - minlon) / ISC_TILE_LON)), 1)
+    edges = np.linspace(minlon, maxlon, nlon + 1)
+    return [(w, ("RECT", minlat, maxlat, edges[i], edges[i + 1])) for w in windows for i in range(nlon)]
+
+def fetchISCTile(session, url, retries=ISC_RETRIES, backoff=ISC_BACKOFF, checkpoint=None):
+    # the mirror answers with an error page when it is busy, so parse errors are retried as well
+    if checkpoint is not None:
+        text = checkpoint.text(url)
+        if text is not None:
+            return fmcsvFrame(text)
+    for attempt in range(retries):
+        if attempt:
+            metrics.count("isc_fetch", retries=1)
+        try:
+            with metrics.stage("isc_fetch"):
+                r = session.get(url, timeout=ISC_TIMEOUT)
+                r.raise_for_status()
+                metrics.count("isc_fetch", bytes=len(r.content))
+            with metrics.stage("isc_parse"):
+                df = fmcsvFrame(r.text)
+                metrics.count("isc_parse", events=0 if df is None else len(df))
+            if checkpoint is not None:
+                checkpoint.saveText(url, r.text)
+            return df
+        except Exception as e:
+            err = e
+            if attempt < retries - 1:
+                time.sleep(backoff * 2**attempt)
+    raise err
+
+def iscFrames(tt1, tt2, region, minD, maxD, minM, maxM, nworkers=1, baseurl=ISC_URL, checkpoint=None):
+    tiles = iscTiles(tt1, tt2, region)
+    session = iscSession(nworkers)
+    urls = [iscUrl(w[0], w[1], reg, minD, maxD, minM, maxM, baseurl=baseurl) for w, reg in tiles]
+    if len(urls) > 1:
+        print("Fetching {} ISC tiles with {} workers".format(len(urls), nworkers))
+    with ThreadPoolExecutor(max_workers=max(nworkers, 1)) as pool:
+        frames = list(pool.map(lambda url: fetchISCTile(session, url, checkpoint=checkpoint), urls))
+    session.close()
+    return [df for df in frames if df is not None]
+
+def mergeFrames(frames):
+    # tiles share their edges: keep every (event, origin author, mechanism author) once, in time order
+    import pandas as pd
+    df = pd.concat(frames, ignore_index=True)
+    df = df.drop_duplicates(subset=[0, 1, 8])
+    return df.sort_values("time", kind="stable")
+###########################################################################################
+def queryFocalMechanisms(query, baseurl=ISC_URL, checkpoint=None):
+    # focal mechanism table of the query from the ISC
+    if query.circular():
+        region = ("CIRC", int(query.clat), int(query.clon), int(query.maxrad))
+    else:
+        region = ("RECT", query.minlat, query.maxlat, query.minlon, query.maxlon)
+    tt1, tt2 = query.times()
+    frames = iscFrames(tt1, tt2, region, query.minD, query.maxD, query.minM, query.maxM, nworkers=query.nworkers, baseurl=baseurl, checkpoint=checkpoint)
+    if not frames:
+        raise RuntimeError("No events Found!")
+    return dict(zip(FM_CATALOG_NAMES, fmColumns(mergeFrames(frames))))
+
+def catalogDownloaderISC(query, baseurl=ISC_URL):
+    checkpoint = openCheckpoint(query, download="isc")
+    try:
+        table = queryFocalMechanisms(query, baseurl=baseurl, checkpoint=checkpoint)
+    except Exception:
+        if checkpoint is not None and checkpoint.parts:
+            print("{}, run the same query again to resume".format(checkpoint.report()))
+        raise
+    saveTable(query.outfile, table, fmt=query.fmt)
+    if checkpoint is not None:
+        checkpoint.remove()
+###########################################################################################
+#Event providers: anything with a name and fetch(tt1, tt2, params) -> event records,
+#params being the FDSN event query parameters (minlatitude, ..., maxmagnitude)
+class FDSNProvider(object):
+    def __init__(self, name, nworkers=1, checkpoint=None):
+        self.name = name
+        self.nworkers = nworkers
+        self.checkpoint = checkpoint
+        self.client = None
+        self.lock = threading.Lock()
+
+    def fetch(self, tt1, tt2, params):
+        # one client per provider, also when batch groups fetch at the same time
+        with self.lock:
+            if self.client is None:
+                from obspy.clients.fdsn import Client
+                self.client = Client(self.name)
+        if self.nworkers > 1 or self.checkpoint is not None:
+            # checkpoints (resume=...) need time windows, even when they are fetched one by one
+            return chunkedEvents(self.client, tt1, tt2, params, nworkers=self.nworkers, checkpoint=self.checkpoint)
+        return fetchWindow(self.client, tt1, tt2, params)
 
-    url = url1 + url2 + url3 + url4 + url5 + url6
-    temp1 = "temp1.tmp"
-    temp2 = "temp2.tmp"
-    r = requests.get(url)
-    with open(temp1, "wb") as file:
-        file.write(r.content)
-
-    with open(temp1, 'r') as fin:
-        data = fin.read().splitlines(True)
-        if not "No events were found.\n" in data:
-            with open(temp2, 'w') as fout:
-                fout.writelines(data[27:-5])
-                forward="go"
+class ISCFocalProvider(object):
+    # events of the ISC focal mechanism search (origin of each mechanism, Mw)
+    name = "ISC-FM"
+
+    def __init__(self, nworkers=1, baseurl=ISC_URL, checkpoint=None):
+        self.nworkers = nworkers
+        self.baseurl = baseurl
+        self.checkpoint = checkpoint
+
+    def fetch(self, tt1, tt2, params):
+        if params.get("latitude") is not None:
+            region = ("CIRC", params["latitude"], params["longitude"], params["maxradius"])
         else:
-            sys.exit("No events Found!")
-    df = pd.read_csv(temp2, header=None)
-    df = df.replace(r'\s+$', np.nan, regex=True)  # replace all the empty strings with NaN
-    df.dropna(subset=[[2, 3, 4, 5, 6, 9, 10, 11, 13]], inplace=True)  # remove all the rows containing NaN
-    eventinfo = []
-    eventinfo.append(list(df.iloc[:, 2].str.split("-").str[0]))
-    eventinfo.append(list(df.iloc[:, 2].str.split("-").str[1]))
-    eventinfo.append(list(df.iloc[:, 2].str.split("-").str[2]))
-    eventinfo.append(list(df.iloc[:, 3].str.split(":").str[0]))
-    eventinfo.append(list(df.iloc[:, 3].str.split(":").str[1]))
-    eventinfo.append(list(df.iloc[:, 3].str.split(":").str[2]))
-    dataindx = [5, 4, 6, 9, 10, 11, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24]
-    for idx in dataindx:
-        eventinfo.append(list(df.iloc[:, idx]))
-
-    frmt = "YEAR; MONTH; DAY; HOUR; MIN; SEC; LONGITUDE; LATITUDE; DEPTH; EXP(Nm); M0; MAG; Mrr; Mtt; Mpp; Mrt; Mtp; Mpr; Str1; Dip1; Rake1; Str2; Dip2; Rake2\n"
-    with open(outfile, 'w') as file:
-        file.write(frmt)
-        for x in zip(*eventinfo):
-            file.write("{:4d};{:2d};{:2d};{:2d};{:2d};{:5.2f};{:9.4f};{:9.4f};{:5.1f};{:2d};{:5.3f};{:3.1f};{:6.3f};{:6.3f};{:6.3f};{:6.3f};{:6.3f};{:6.3f};{: 7.2f};{:5.2f};{:7.2f};{:7.2f};{:5.2f};{:7.2f}\n".format(int(x[0]), int(x[1]), int(x[2]), int(x[3]), int(x[4]), float(x[5]), float(x[6]), float(x[7]), float(x[8]), int(x[9]), float(x[10]), float(x[11]), float(x[12]), float(x[13]), float(x[14]), float(x[15]), float(x[16]), float(x[17]), float(x[18]), float(x[19]), float(x[20]), float(x[21]), float(x[22]), float(x[23])))
-    tmpfiles = ["temp1.tmp","temp2.tmp"]
-    for x in tmpfiles:
-        os.remove(x)
+            region = ("RECT", params.get("minlatitude") or -90, params.get("maxlatitude") or 90,
+                      params.get("minlongitude") or -180, params.get("maxlongitude") or 180)
+        frames = iscFrames(tt1, tt2, region, params.get("mindepth") or 0, params.get("maxdepth") or 700,
+                           params.get("minmagnitude") or "", params.get("maxmagnitude") or "", nworkers=self.nworkers, baseurl=self.baseurl,
+                           checkpoint=self.checkpoint)
+        if not frames:
+            return cat_events.empty()
+        df = mergeFrames(frames).drop_duplicates(subset=[0])
+        return cat_events.records(("isc:" + df[0].astype(str)).tolist(), df["time"].values.astype("datetime64[us]"),
+                                  df[5].values.astype(float), df[4].values.astype(float), df[6].values.astype(float),
+                                  np.full(len(df), "Mw"), df[11].values.astype(float), np.full(len(df), ""))
+
+def makeProviders(names, nworkers=1, checkpoint=None):
+    return [ISCFocalProvider(nworkers=nworkers, checkpoint=checkpoint) if name == "ISC-FM" else FDSNProvider(name, nworkers=nworkers, checkpoint=checkpoint)
+            for name in names]
 ###########################################################################################
-def EQFinder(yearS=stv[0], monthS=stv[1], dayS=stv[2], hourS=stv[3], minuteS=stv[4], secondS=stv[5], yearE=etv[0], monthE=etv[1], dayE=etv[2], hourE=etv[3], minuteE=etv[4],secondE=etv[5],minlat=mnlat, maxlat=mxlat, minlon=mnlon, maxlon=mxlon, minD=mnD, maxD=mxD, minM=mnM, maxM=mxM,clat=clat,clon=clon,maxrad=maxrad,minrad=minrad, outfile=out):
-    if fm=="yes":
+#Federated search
+ASSOC_TIME = 16.    # (s) origin time tolerance for the same event in two catalogs
+ASSOC_DIST = 1.     # (deg) epicentral distance tolerance
+ASSOC_MAG = 1.      # magnitude tolerance (different magnitude types)
+
+def associated(ref, cols, dt=ASSOC_TIME, ddeg=ASSOC_DIST, dmag=ASSOC_MAG):
+    """
+    Boolean mask of the events in cols which match an event of ref within the time,
+    distance and magnitude tolerances. Candidates come from a time-sorted index of ref.
+    """
+    order = np.argsort(ref["time"], kind="stable")
+    tref = ref["time"][order]
+    t = cols["time"]
+    delta = np.timedelta64(int(dt * 1e6), "us")
+    lo = np.searchsorted(tref, t - delta, side="left")
+    hi = np.searchsorted(tref, t + delta, side="right")
+    counts = hi - lo
+    match = np.zeros(len(t), dtype=bool)
+    if counts.sum() == 0:
+        return match
+    # every (event, candidate) pair inside the time window
+    ev = np.repeat(np.arange(len(t)), counts)
+    cand = order[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    lat1, lon1 = np.radians(cols["lat"][ev]), np.radians(cols["lon"][ev])
+    lat2, lon2 = np.radians(ref["lat"][cand]), np.radians(ref["lon"][cand])
+    cosd = np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(lon1 - lon2)
+    dist = np.degrees(np.arccos(np.clip(cosd, -1, 1)))
+    dm = np.abs(cols["mag"][ev] - ref["mag"][cand])
+    ok = (dist <= ddeg) & ~(dm > dmag)    # missing magnitudes do not prevent a match
+    match[ev[ok]] = True
+    return match
+
+def federatedEvents(providers, tt1, tt2, params, mode="merge"):
+    """
+    Query all providers concurrently.
+    mode="first": the first successful response wins.
+    mode="merge": events of the later providers which are not associated with an event
+    of the earlier ones are added (providers are listed by priority).
+    """
+    pool = ThreadPoolExecutor(max_workers=len(providers))
+    jobs = dict((pool.submit(p.fetch, tt1, tt2, params), p) for p in providers)
+    results = {}
+    try:
+        for job in as_completed(jobs):
+            provider = jobs[job]
+            try:
+                results[provider.name] = job.result()
+            except Exception as e:
+                print("Provider {} failed in the {} stage: {}".format(provider.name, getattr(e, "stage", "fetch"), e))
+                continue
+            if mode == "first":
+                print("Using the events of {}".format(provider.name))
+                return results[provider.name]
+    finally:
+        pool.shutdown(wait=False)
+    if not results:
+        raise RuntimeError("All providers failed")
+
+    merged = None
+    with metrics.stage("federate"):
+        for provider in providers:
+            cols = results.get(provider.name)
+            if cols is None:
+                continue
+            if merged is None:
+                merged = cols
+                continue
+            new = ~associated(merged, cols)
+            print("{}: {} events, {} not in the earlier catalogs".format(provider.name, len(cols["id"]), new.sum()))
+            merged = cat_events.concat([merged, cols[new]])
+        metrics.count("federate", events=len(merged["id"]))
+    return merged[np.argsort(merged["time"], kind="stable")[::-1]]
+###########################################################################################
+def find_events(query, fallback=False):
+    """
+    Catalog table of the query: dict of columns named like the catalog header
+    (focal mechanism columns with query.fm). Errors are raised to the caller; with
+    fallback=True a failed ISC download gives the event table of the providers instead
+    (like the command line), without the focal mechanism columns.
+    """
+    if query.local:
+        return localEvents(query)
+    if query.fm:
         try:
-            catalogDownloaderISC(yearS=yearS, monthS=monthS, dayS=dayS, hourS=hourS, minuteS=minuteS, secondS=secondS, yearE=yearE, monthE=monthE, dayE=dayE, hourE=hourE, minuteE=minuteE,secondE=secondE,minlat=minlat, maxlat=maxlat, minlon=minlon, maxlon=maxlon,clat=clat,clon=clon,maxrad=maxrad, minD=minD, maxD=maxD, minM=minM, maxM=maxM, outfile=outfile)
-        except:
-            print("Unable to fetch the data from ISC")
-            catalogDownloader(yearS=int(yearS), monthS=int(monthS), dayS=int(dayS), hourS=int(hourS), minuteS=int(minuteS), secondS=float(secondS), yearE=int(yearE), monthE=int(monthE), dayE=int(dayE), hourE=int(hourE), minuteE=int(minuteE),secondE=float(secondE),minlat=minlat, maxlat=maxlat, minlon=minlon, maxlon=maxlon,clat=clat,clon=clon,minrad=minrad,maxrad=maxrad, minD=float(minD), maxD=float(maxD), minM=float(minM), maxM=float(maxM))
-    else:
-        catalogDownloader(yearS=int(yearS), monthS=int(monthS), dayS=int(dayS), hourS=int(hourS), minuteS=int(minuteS), secondS=float(secondS), yearE=int(yearE), monthE=int(monthE), dayE=int(dayE), hourE=int(hourE), minuteE=int(minuteE),secondE=float(secondE),minlat=minlat, maxlat=maxlat, minlon=minlon, maxlon=maxlon,clat=clat,clon=clon,minrad=minrad,maxrad=maxrad, minD=float(minD), maxD=float(maxD), minM=float(minM), maxM=float(maxM))
+            return queryFocalMechanisms(query)
+        except Exception as e:
+            if not fallback:
+                raise
+            print("Unable to fetch the data from ISC ({} stage: {})".format(getattr(e, "stage", "isc_fetch"), e))
+    return eventTable(queryEvents(query))
+
+def localEvents(query):
+    # catalog table of the query from the catalog file query.local
+    import cat_index
+    with metrics.stage("local_query"):
+        index = cat_index.CatalogIndex.load(query.local)
+        table = index.query(query)
+        metrics.count("local_query", events=index.cost["matches"])
+    print("Local query of {}: {}".format(query.local, index.report()))
+    return table
+
+def EQFinder(query=None, **kwargs):
+    # download the catalog of the query (or EventQuery(**kwargs)) into query.outfile
+    if query is None:
+        query = EventQuery(**kwargs)
+    metrics.reset()
+    if query.local:
+        try:
+            saveTable(query.outfile, localEvents(query), fmt=query.fmt)
+        except Exception as e:
+            print("Failed to query the local catalog {} in the {} stage: {}".format(query.local, getattr(e, "stage", "local_query"), e))
+        return
+    if query.fm:
+        try:
+            catalogDownloaderISC(query)
+            return
+        except Exception as e:
+            print("Unable to fetch the data from ISC ({} stage: {})".format(getattr(e, "stage", "isc_fetch"), e))
+    catalogDownloader(query)
 ##########################################################################################
-if __name__=="__main__":
-    EQFinder()
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    warnings.filterwarnings("ignore")
+    print(sug)
+    query = parseArgs(argv[1] if len(argv) > 1 else "")
+    printQuery(query)
+    out = query.outfile
+    if query.local and os.path.abspath(query.local) == os.path.abspath(out):
+        sys.exit("The output file would overwrite the local catalog, choose another outfile")
+    if os.path.exists(out) and not query.batch:
+        os.remove(out)
+    metrics.profile = query.profile
+    try:
+        runQuery(query)
+    finally:
+        if query.metrics:
+            metrics.write(query.metrics)
+
+def runQuery(query):
+    # one run: the metrics cover its download, batch or watch and its plots
+    metrics.reset()
+    out = query.outfile
+    if query.watch:
+        import cat_watch
+        cat_watch.watch(query, interval=query.watch, emit=query.emit, tiles=query.tiles)
+        return
+    if query.batch:
+        import cat_batch
+        cat_batch.runBatch(cat_batch.readBatch(query.batch), nworkers=query.nworkers)
+        return
+    EQFinder(query)
     if os.path.exists(out):
         num=num_events(out)
         print("Number of events found: {}".format(num))
-        if 1<=num<15000:
+        if num>=1 and query.tiles:
+            import cat_tiles
+            cat_tiles.catalogTiles(out, query.tiles)
+        elif num>=1:
             print("Plotting events...please wait...")
             import cat_plot
             fignm="EQmap.png"
             cat_plot.eqqplot(out, fignm)
 
+if __name__=="__main__":
+    main()
@@ -0,0 +1,36 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from obspy.clients import fdsn
+
+import cat_batch
+import cat_events
+import earthquakeFinder as eqf
+
+'''
+Batch files: queries of the lines, malformed lines are skipped; providers shared by the groups.
+'''
+
+def test_malformed_lines_are_skipped(tmp_path, capsys):
+    path = tmp_path / "regions.txt"
+    path.write_text("# regions\nclat=22,clon=121,mxrad=2,mnmag=3,outfile=taiwan.txt\nmnla=30,mxla=abc\n\n"
+                    "mnla=30,mxla=46,mnlo=128,mxlo=146,mnmagg=4\nmnla=30,mxla=46,st=2016/3\n")
+    queries = cat_batch.readBatch(str(path))
+    assert [q.outfile for q in queries] == ["taiwan.txt", "catalog_6.txt"]
+    assert queries[0].maxrad == 2 and queries[1].minlat == 30 and queries[1].starttime.month == 3
+    out = capsys.readouterr().out
+    assert "Skipping line 3 of" in out and "Skipping line 5 of" in out and "mnmagg" in out
+
+def test_provider_makes_one_client_for_concurrent_fetches(monkeypatch):
+    made = []
+    class Client(object):
+        def __init__(self, name):
+            time.sleep(0.05)    # the service discovery of the real client takes a while
+            made.append(threading.get_ident())
+    monkeypatch.setattr(fdsn, "Client", Client)
+    monkeypatch.setattr(eqf, "fetchWindow", lambda client, tt1, tt2, params: cat_events.empty())
+    provider = eqf.FDSNProvider("IRIS")
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda i: provider.fetch(None, None, {}), range(4)))
+    assert len(made) == 1
@@ -0,0 +1,39 @@
+import numpy as np
+
+import cat_index
+import cat_plot
+import earthquakeFinder as eqf
+
+'''
+Catalog files: a table read back from a text catalog is written as npz and read again.
+'''
+
+def textTable(tmp_path):
+    table = dict(YEAR=np.array([2016, 2016, 2017]), MONTH=np.array([3, 4, 1]), DAY=np.array([29, 1, 2]),
+                 HOUR=np.array([1, 2, 3]), MINUTES=np.array([4, 5, 6]), SECONDS=np.array([7.5, 8.25, 9.]),
+                 LONGITUDE=np.array([121.5, 122.25, -70.]), LATITUDE=np.array([22.5, 23., -30.]), DEPTH=np.array([10., 35.5, 120.]),
+                 MAG_TYPE=np.array(["mb", "", "Mw"]), MAG=np.array([4.5, 5., 6.1]), EVENT_NAME=np.array(["TAIWAN", "TAIWAN", "CHILE"]))
+    path = str(tmp_path / "catalog.txt")
+    eqf.saveTable(path, table)
+    return table, cat_index.readCatalog(path)
+
+def test_text_catalog_is_written_as_npz_and_read_back(tmp_path):
+    table, text = textTable(tmp_path)
+    assert np.asarray(text["MAG_TYPE"]).dtype == object
+    path = str(tmp_path / "catalog.npz")
+    eqf.saveTable(path, text, fmt="npz")
+    back = cat_index.readCatalog(path)
+    assert back["MAG_TYPE"].dtype.kind == "U" and back["MAG_TYPE"].tolist() == ["mb", "", "Mw"]
+    assert back["EVENT_NAME"].tolist() == ["TAIWAN", "TAIWAN", "CHILE"]
+    for name in ["YEAR", "SECONDS", "LONGITUDE", "LATITUDE", "DEPTH", "MAG"]:
+        assert np.array_equal(back[name], table[name])
+
+def test_local_query_of_a_text_catalog_written_as_npz(tmp_path):
+    table, text = textTable(tmp_path)
+    query = eqf.EventQuery(starttime=eqf.datetime.datetime(2016, 1, 1), endtime=eqf.datetime.datetime(2018, 1, 1),
+                           clat=22, clon=121, maxrad=5, minM=0, local=str(tmp_path / "catalog.txt"))
+    path = str(tmp_path / "subset.npz")
+    eqf.saveTable(path, eqf.localEvents(query), fmt="npz")
+    lon, lat, dep, mag = cat_plot.cinput(path)[:4]
+    assert sorted(np.asarray(lat, dtype=float).tolist()) == [22.5, 23.]
+    assert sorted(np.asarray(mag, dtype=float).tolist()) == [4.5, 5.]
@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+import pytest
+
+import cat_events
+import earthquakeFinder as eqf
+
+'''
+Federated queries against stand-in providers: association of the same event in two catalogs,
+merge, first response and failing providers.
+'''
+
+T0 = np.datetime64("2016-03-29T12:00:00", "us")
+
+
+def events(rows, magtype="mb", name="TAIWAN"):
+    # rows of (seconds after T0, lon, lat, mag)
+    rows = np.array(rows, dtype=float).reshape(-1, 4)
+    return cat_events.records(np.arange(len(rows)), T0 + (rows[:, 0] * 1e6).astype("timedelta64[us]"), rows[:, 1], rows[:, 2],
+                              np.full(len(rows), 10.), np.full(len(rows), magtype), rows[:, 3], np.full(len(rows), name))
+
+
+class Provider(object):
+    def __init__(self, name, events=None, delay=0., error=None):
+        self.name = name
+        self.events = events
+        self.delay = delay
+        self.error = error
+
+    def fetch(self, tt1, tt2, params):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.events
+
+
+###########################################################################################
+def test_associated_within_the_tolerances():
+    ref = events([(0, 121., 22., 5.)])
+    cols = events([(10, 121.5, 22.5, 5.5),                   # same event, other catalog
+                   (eqf.ASSOC_TIME + 1, 121., 22., 5.),      # too late
+                   (0, 123., 22., 5.),                       # too far
+                   (0, 121., 22., 6.5),                      # other magnitude
+                   (-5, 121.2, 21.9, np.nan)])               # no magnitude
+    assert eqf.associated(ref, cols).tolist() == [True, False, False, False, True]
+    assert not eqf.associated(cat_events.empty(), cols).any()
+
+def test_merge_adds_the_events_which_are_not_associated():
+    first = events([(0, 121., 22., 5.), (3600, 140., 35., 6.)], magtype="mb")
+    second = events([(5, 121.1, 22.1, 5.2), (7200, -70., -30., 4.5), (3602, 140.2, 35.1, 6.1)], magtype="Mw", name="CHILE")
+    merged = eqf.federatedEvents([Provider("A", first), Provider("B", second, delay=0.05)], None, None, {})
+    assert len(merged) == 3
+    assert np.all(np.diff(merged["time"].astype(np.int64)) <= 0)        # newest first
+    assert merged["lon"].tolist() == [-70., 140., 121.]
+    assert cat_events.magtypes(merged).tolist() == ["Mw", "mb", "mb"]
+    assert cat_events.names(merged).tolist() == ["CHILE", "TAIWAN", "TAIWAN"]
+
+def test_merge_keeps_the_priority_of_the_providers():
+    # the first provider of the list wins the associated events, whichever answers first
+    first = events([(0, 121., 22., 5.)], magtype="mb")
+    second = events([(1, 121.1, 22.1, 5.2)], magtype="Mw")
+    merged = eqf.federatedEvents([Provider("A", first, delay=0.1), Provider("B", second)], None, None, {})
+    assert cat_events.magtypes(merged).tolist() == ["mb"]
+
+def test_first_response_wins():
+    slow = Provider("A", events([(0, 121., 22., 5.)]), delay=0.5)
+    fast = Provider("B", events([(1, 140., 35., 6.), (2, 141., 36., 6.)]))
+    result = eqf.federatedEvents([slow, fast], None, None, {}, mode="first")
+    assert result["lon"].tolist() == [140., 141.]
+
+def test_failing_provider_is_skipped():
+    ok = events([(0, 121., 22., 5.)])
+    for mode in ("merge", "first"):
+        result = eqf.federatedEvents([Provider("A", error=IOError("timed out")), Provider("B", ok, delay=0.05)], None, None, {}, mode=mode)
+        assert result["lon"].tolist() == [121.]
+
+def test_all_providers_failing_raise():
+    with pytest.raises(RuntimeError):
+        eqf.federatedEvents([Provider("A", error=IOError("timed out")), Provider("B", error=ValueError("bad page"))], None, None, {})
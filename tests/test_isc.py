@@ -0,0 +1,183 @@
+import os
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+
+import cat_bench
+import cat_events
+import cat_resume
+import earthquakeFinder as eqf
+from cat_metrics import metrics
+
+'''
+Tiled ISC focal mechanism downloads against a local stand-in of the ISC search: tile
+splitting, retries with backoff and events on the shared edges of the tiles.
+'''
+
+
+class ISCStub(object):
+    # FMCSV pages of the rows inside the time range and longitudes of each request,
+    # the first len(failures) requests get an HTTP error code or a busy page instead
+    def __init__(self, rows, failures=()):
+        self.rows = rows    # (event id, datetime, lat, lon)
+        self.failures = list(failures)
+        self.urls = []
+        self.served = 0     # rows of all the pages
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = "http://127.0.0.1:{}/cgi-bin/web-db-v4".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def page(self, query):
+        q = dict((k, v[0]) for k, v in parse_qs(query, keep_blank_values=True).items())
+        def when(prefix):
+            return datetime.datetime.strptime("{}-{}-{} {}".format(q[prefix + "_year"], q[prefix + "_month"], q[prefix + "_day"],
+                                                                q[prefix + "_time"]), "%Y-%m-%d %H:%M:%S")
+        t1, t2 = when("start"), when("end")
+        left, right = float(q["left_lon"] or -180), float(q["right_lon"] or 180)
+        rows = [FMCSV_ROW(*row) for row in self.rows if t1 <= row[1] <= t2 and left <= row[3] <= right]
+        with self.lock:
+            self.served += len(rows)
+        if not rows:
+            return "<html>No events were found.\n</html>"
+        return "\n".join(cat_bench.FMCSV_HEAD + rows + cat_bench.FMCSV_TAIL)
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.urls.append(self.path)
+                    failure = stub.failures.pop(0) if stub.failures else None
+                if isinstance(failure, int):
+                    self.send_error(failure)
+                    return
+                body = (failure or stub.page(self.path.partition("?")[2])).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+BUSY = "<html><body>The server is busy, please try again later</body></html>"
+
+def FMCSV_ROW(evid, t, lat, lon):
+    return cat_bench.FMCSV_ROW % ((evid, t.strftime("%Y-%m-%d"), t.strftime("%H:%M:%S.00"), lat, lon, 10., 1.5, 6.1) +
+                                  (0.1, -0.2, 0.1, 0.3, -0.4, 0.5) + (10., 45., 90., 190., 45., 90.))
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # backoff delays of fetchISCTile, without waiting
+    delays = []
+    monkeypatch.setattr(eqf.time, "sleep", delays.append)
+    return delays
+
+
+###########################################################################################
+def test_rect_tiles_split_time_and_longitude():
+    tt1, tt2 = UTCDateTime(2015, 1, 1), UTCDateTime(2016, 2, 5)     # 400 days
+    tiles = eqf.iscTiles(tt1, tt2, ("RECT", -30, 30, -180, 180))
+    windows = []
+    for w, region in tiles:
+        if w not in windows:
+            windows.append(w)
+    assert len(tiles) == 3 * 3
+    assert windows[0][0] == tt1 and windows[-1][1] == tt2
+    assert all(w[1] - w[0] <= eqf.ISC_TILE_DAYS * 86400 for w in windows)
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+    lons = sorted(set(region[3:] for w, region in tiles))
+    assert lons == [(-180, -60), (-60, 60), (60, 180)]
+    assert all(region[1:3] == (-30, 30) for w, region in tiles)
+
+def test_narrow_and_circular_regions_are_not_split_in_longitude():
+    tt1, tt2 = UTCDateTime(2015, 1, 1), UTCDateTime(2015, 3, 1)
+    assert [region for w, region in eqf.iscTiles(tt1, tt2, ("RECT", 20, 27, 118, 124))] == [("RECT", 20, 27, 118, 124)]
+    tiles = eqf.iscTiles(tt1, UTCDateTime(2016, 1, 1), ("CIRC", 22, 121, 5))
+    assert len(tiles) == 3 and all(region == ("CIRC", 22, 121, 5) for w, region in tiles)
+
+def test_tile_is_retried_with_backoff(sleeps):
+    stub = ISCStub([(1, datetime.datetime(2015, 2, 1), 22., 121.)], failures=[503, BUSY])
+    try:
+        metrics.reset()
+        url = eqf.iscUrl(UTCDateTime(2015, 1, 1), UTCDateTime(2015, 3, 1), ("RECT", -90, 90, -180, 180), 0, 700, 4, 10, baseurl=stub.url)
+        df = eqf.fetchISCTile(eqf.iscSession(), url, retries=3, backoff=0.5)
+    finally:
+        stub.close()
+    assert len(stub.urls) == 3
+    assert sleeps == [0.5, 1.0]
+    assert metrics.stages["isc_fetch"]["retries"] == 2
+    assert df[0].tolist() == [1]
+
+def test_tile_fails_after_its_retries(sleeps):
+    stub = ISCStub([], failures=[503] * 5)
+    try:
+        url = eqf.iscUrl(UTCDateTime(2015, 1, 1), UTCDateTime(2015, 3, 1), ("RECT", -90, 90, -180, 180), 0, 700, 4, 10, baseurl=stub.url)
+        with pytest.raises(Exception) as err:
+            eqf.fetchISCTile(eqf.iscSession(), url, retries=3, backoff=0.5)
+    finally:
+        stub.close()
+    assert len(stub.urls) == 3
+    assert sleeps == [0.5, 1.0]
+    assert err.value.stage == "isc_fetch"
+
+def test_events_on_tile_edges_are_kept_once(sleeps):
+    edge = datetime.datetime(2015, 1, 1) + datetime.timedelta(days=eqf.ISC_TILE_DAYS)
+    rows = [(1, datetime.datetime(2015, 1, 10), 0., -60.),     # on the edge of two longitude tiles
+            (2, datetime.datetime(2015, 3, 1), 10., 60.),      # on the other longitude edge
+            (3, edge, -5., 0.),                                # on the edge of two time windows
+            (4, edge, 5., 60.),                                # on both edges (four tiles)
+            (5, datetime.datetime(2015, 12, 1), 45., 170.),
+            (6, datetime.datetime(2015, 5, 1), -20., -170.)]
+    stub = ISCStub(rows, failures=[BUSY])
+    query = eqf.EventQuery(starttime=datetime.datetime(2015, 1, 1), endtime=datetime.datetime(2016, 2, 5), minM=4, fm=True, nworkers=3)
+    try:
+        table = eqf.queryFocalMechanisms(query, baseurl=stub.url)
+    finally:
+        stub.close()
+    assert len(stub.urls) == 3 * 3 + 1       # one tile retried
+    assert stub.served == len(rows) + 1 + 1 + 1 + 3    # the copies of the events 1, 2, 3 and 4
+    assert len(table["YEAR"]) == len(rows)
+    epoch = [datetime.datetime(y, mo, d, h, mi) for y, mo, d, h, mi in zip(table["YEAR"], table["MONTH"], table["DAY"], table["HOUR"], table["MIN"])]
+    assert epoch == sorted(row[1] for row in rows)
+    assert sorted(zip(table["LATITUDE"].tolist(), table["LONGITUDE"].tolist())) == sorted((row[2], row[3]) for row in rows)
+    assert np.all(table["Str1"] == 10.)
+
+def test_fdsn_fallback_keeps_the_isc_checkpoint(sleeps, monkeypatch, tmp_path):
+    # the first tile is downloaded, the second one fails: EQFinder falls back to the FDSN events
+    stub = ISCStub([(1, datetime.datetime(2015, 2, 1), 22., 121.)], failures=[None] + [503] * eqf.ISC_RETRIES)
+    downloader = eqf.catalogDownloaderISC
+    monkeypatch.setattr(eqf, "catalogDownloaderISC", lambda query: downloader(query, baseurl=stub.url))
+    monkeypatch.setattr(eqf, "queryEvents", lambda query, checkpoint=None: cat_events.empty())
+    query = eqf.EventQuery(starttime=datetime.datetime(2015, 1, 1), endtime=datetime.datetime(2015, 12, 1), minlat=20, maxlat=25,
+                           minlon=118, maxlon=124, minM=4, fm=True, resume=str(tmp_path / "resume"), outfile=str(tmp_path / "catalog.txt"))
+    try:
+        eqf.EQFinder(query)
+    finally:
+        stub.close()
+    assert os.path.exists(query.outfile)
+    kept = [cat_resume.Checkpoint(os.path.join(query.resume, name)) for name in os.listdir(query.resume)]
+    assert [len(checkpoint.parts) for checkpoint in kept] == [1]
+
+def test_find_events_raises_unless_it_falls_back(monkeypatch):
+    def failing(query):
+        raise RuntimeError("No events Found!")
+    monkeypatch.setattr(eqf, "queryFocalMechanisms", failing)
+    monkeypatch.setattr(eqf, "queryEvents", lambda query, checkpoint=None: cat_events.empty())
+    query = eqf.EventQuery(fm=True)
+    with pytest.raises(RuntimeError):
+        eqf.find_events(query)
+    table = eqf.find_events(query, fallback=True)
+    assert "YEAR" in table and "Str1" not in table